@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Compare the diff backends of juju_compose.diff on relation modules.
+
+    python benchmarks/bench_diff.py [-n REPEAT] [--scale N] [module.py ...]
+
+Each module (by default the interfaces under tests/interfaces and the
+composer's own modules) is scaled up to N copies, with renamed
+definitions, to approximate a large relation module. It is then diffed
+against a copy with renamed states, dropped lines and added handlers, the
+kind of edit a layer makes when overriding an interface.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from juju_compose import diff  # noqa
+
+HANDLER = """
+@when('{0}.extra')
+def extra_{0}(self):
+    self.set_state('{0}.extra.done')
+"""
+
+
+def scale(text, n):
+    return "".join(text.replace("def ", "def c%d_" % k)
+                   .replace("class ", "class C%d" % k) for k in range(n))
+
+
+def mutate(text):
+    lines = text.splitlines(True)
+    out = []
+    for i, line in enumerate(lines):
+        if "set_state(" in line and i % 3 == 0:
+            line = line.replace("set_state(", "set_state('renamed', ")
+        if i % 97 == 50:
+            continue
+        out.append(line)
+        if i % 211 == 0:
+            out.append(HANDLER.format("s%d" % i))
+    return "".join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=diff.DIFF_TIMEOUT)
+    parser.add_argument('modules', nargs='*')
+    options = parser.parse_args()
+    root = os.path.join(os.path.dirname(__file__), "..")
+    modules = options.modules or sorted(
+        glob.glob(os.path.join(root, "tests", "interfaces", "*", "*.py")) +
+        glob.glob(os.path.join(root, "juju_compose", "*.py")))
+    backends = [cls(options.timeout) for cls in diff.BACKENDS.values()
+                if cls.available]
+    print "{:<40} {:>7} ".format("module", "lines") + " ".join(
+        "{:>10}".format(b.name) for b in backends)
+    for module in modules:
+        with open(module) as fp:
+            text = scale(fp.read(), options.scale)
+        changed = mutate(text)
+        timings = []
+        for backend in backends:
+            best = None
+            for _ in range(options.repeat):
+                start = time.time()
+                backend.diff(text, changed)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+        print "{:<40} {:>7} ".format(
+            os.path.relpath(module)[-40:], text.count("\n")) + " ".join(
+            "{:>9.1f}ms".format(t * 1000) for t in timings)
+
+
+if __name__ == '__main__':
+    main()
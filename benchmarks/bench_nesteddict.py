@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Time dotted key access on utils.NestedDict.
+
+    python benchmarks/bench_nesteddict.py [--keys N] [--depth D] [-n ROUNDS]
+
+Builds a NestedDict from N dotted keys D levels deep and times setting
+them, then repeated rounds of item, get() and attribute lookups. The
+same operations are timed on the NestedDict as it was before dotted
+keys were cached, as a baseline.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from juju_compose import utils  # noqa
+
+
+class BaselineNestedDict(dict):
+    """utils.NestedDict before dotted keys were cached"""
+    def __setitem__(self, key, value):
+        key = key.split('.')
+        o = self
+        for part in key[:-1]:
+            o = o.setdefault(part, self.__class__())
+        dict.__setitem__(o, key[-1], value)
+
+    def __getitem__(self, key):
+        o = self
+        if '.' in key:
+            parts = key.split('.')
+            key = parts[-1]
+            for part in parts[:-1]:
+                o = o[part]
+
+        return dict.__getitem__(o, key)
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def timed(label, fn, count):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print "{:<28} {:>9.1f}ms {:>9.2f}us/op".format(
+        label, elapsed * 1000, elapsed * 1e6 / count)
+
+
+def run(cls, keys, rounds):
+    d = cls()
+
+    def setall():
+        for i, key in enumerate(keys):
+            d[key] = i
+
+    def getitem():
+        for _ in range(rounds):
+            for key in keys:
+                d[key]
+
+    def get():
+        for _ in range(rounds):
+            for key in keys:
+                d.get(key)
+
+    def get_missing():
+        for _ in range(rounds):
+            for key in keys:
+                d.get(key + "x")
+
+    first = keys[0].split(".")[0]
+
+    def getattr_():
+        for _ in range(rounds):
+            for _ in keys:
+                getattr(d, first)
+
+    lookups = rounds * len(keys)
+    print cls.__name__
+    timed("set", setall, len(keys))
+    timed("d[key]", getitem, lookups)
+    timed("d.get(key)", get, lookups)
+    timed("d.get(missing)", get_missing, lookups)
+    timed("getattr(d, name)", getattr_, lookups)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', type=int, default=5000)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('-n', '--rounds', type=int, default=20)
+    options = parser.parse_args()
+    keys = [".".join("k{}".format((i >> (3 * level)) % 8 + level * 10)
+                     for level in range(options.depth - 1)) +
+            ".opt{}".format(i) for i in range(options.keys)]
+    run(BaselineNestedDict, keys, options.rounds)
+    print
+    run(utils.NestedDict, keys, options.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
-import json
 import logging
 import os
 import sys
 
-import blessings
 from collections import OrderedDict
 from path import path
-from juju_compose import inspector, tactics
+from juju_compose import cache, diff, inspector, lazy, lint, tactics, watch
+from juju_compose.manifest import Manifest
 from juju_compose.config import (ComposerConfig, DEFAULT_IGNORES)
-from juju_compose.fetchers import (InterfaceFetcher,
-                                   LayerFetcher,
-                                   get_fetcher,
-                                   FetchError)
 import utils
 
+blessings = lazy.LazyModule("blessings")
+daemon = lazy.LazyModule("juju_compose.daemon")
+fetchers = lazy.LazyModule("juju_compose.fetchers")
+
 log = logging.getLogger("composer")
 
 
@@ -65,8 +64,8 @@ class Fetched(Configable):
 
     def fetch(self):
         try:
-            fetcher = get_fetcher(self.url)
-        except FetchError:
+            fetcher = fetchers.get_fetcher(self.url)
+        except fetchers.FetchError:
             # We might be passing a local dir path directly
             # which fetchers don't currently  support
             self.directory = path(self.url)
@@ -84,6 +83,12 @@ class Fetched(Configable):
                 "Do you need to set {}?".format(
                     self.url, self.ENVIRON))
 
+        return self.use(self.directory)
+
+    def use(self, directory):
+        """Take directory, as resolved by an earlier fetch, as the
+        source"""
+        self.directory = path(directory)
         self.config_file = self.directory / self.CONFIG_FILE
         self._name = self.config.name
         return self
@@ -109,6 +114,26 @@ class Composer(object):
         self.config = ComposerConfig()
         self.force = False
         self.inplace = False
+        self.quick = False
+        self.verify = True
+        self.diff_backend = None
+        self.lint_mode = "diff"
+        self.format = "text"
+        self.stats = False
+        self.subdir = None
+        self.depth = None
+        self.jobs = None
+        self.build_cache = False
+        self.build_cache_size = 1024
+        self.cache_server = None
+        self.digests = None
+        # (kind, url, deps, cwd, search paths) -> directory of layers and
+        # interfaces fetched by earlier builds, when kept between them
+        self.resolved = None
+        self.watch = False
+        # (layer, config) pairs the last plan was built with
+        self._layer_configs = []
+        self._relations = None
 
     def create_repo(self):
         # Generated output will go into this directory
@@ -135,8 +160,23 @@ class Composer(object):
         else:
             raise ValueError("%s doesn't seem valid", self.charm.directory)
 
+    def fetch_entity(self, cls, url):
+        """Fetch a Layer or Interface, reusing the directory an earlier
+        build resolved url to when resolutions are kept"""
+        if self.resolved is None:
+            return cls(url, self.deps).fetch()
+        key = (cls.__name__, url, self.deps, os.getcwd()) + tuple(
+            os.environ.get(k) for k in ("JUJU_REPOSITORY", Layer.ENVIRON,
+                                        Interface.ENVIRON))
+        directory = self.resolved.get(key)
+        if directory is not None and directory.exists():
+            return cls(url, self.deps).use(directory)
+        entity = cls(url, self.deps).fetch()
+        self.resolved[key] = entity.directory
+        return entity
+
     def fetch(self):
-        layer = Layer(self.charm, self.deps).fetch()
+        layer = self.fetch_entity(Layer, self.charm)
         if not layer.configured:
             log.info("The top level layer expects a "
                      "valid composer.yaml file, "
@@ -182,10 +222,10 @@ class Composer(object):
 
         for base in baselayers:
             if base.startswith("interface:"):
-                iface = Interface(base, self.deps).fetch()
+                iface = self.fetch_entity(Interface, base)
                 results["interfaces"].append(iface)
             else:
-                base_layer = Layer(base, self.deps).fetch()
+                base_layer = self.fetch_entity(Layer, base)
                 self.fetch_dep(base_layer, results)
                 results["layers"].append(base_layer)
 
@@ -206,12 +246,14 @@ class Composer(object):
         config = config.add_config(
             layers["layers"][0] / ComposerConfig.DEFAULT_FILE, True)
 
+        self._layer_configs = []
         for i, layer in enumerate(layers["layers"]):
             log.info("Processing layer: %s", layer.url)
             if i + 1 < len(layers["layers"]):
                 next_layer = layers["layers"][i + 1]
                 config = config.add_config(
                     next_layer / ComposerConfig.DEFAULT_FILE, True)
+            self._layer_configs.append((layer, config))
             list(e for e in utils.walk(layer.directory,
                                        self.build_tactics,
                                        current=layer,
@@ -229,13 +271,8 @@ class Composer(object):
             if not meta:
                 return
             target_config = layers["layers"][-1].config
-            specs = []
-            used_interfaces = set()
-            for kind in ("provides", "requires", "peer"):
-                for k, v in meta.get(kind, {}).items():
-                    # ex: ["provides", "db", "mysql"]
-                    specs.append([kind, k, v["interface"]])
-                    used_interfaces.add(v["interface"])
+            specs = self._relations = relation_specs(meta)
+            used_interfaces = set(spec[2] for spec in specs)
 
             for iface in layers["interfaces"]:
                 if iface.name not in used_interfaces:
@@ -268,47 +305,133 @@ class Composer(object):
         self.plan_interfaces(layers, output_files, self.plan)
         return self.plan
 
+    def plan_paths(self, relpaths):
+        """Build {relpath: tactic} for just relpaths of the layers,
+        combining them through the layers as plan_layers does"""
+        output_files = OrderedDict()
+        for layer, config in self._layer_configs:
+            for rel in sorted(relpaths):
+                entry = layer.directory / rel
+                if entry.isfile():
+                    self.build_tactics(entry, layer, config, output_files)
+        return output_files
+
     def exec_plan(self, plan=None, layers=None):
-        signatures = {}
-        cont = True
-        for phase in ['lint', 'read', '__call__', 'sign']:
-            for tactic in plan:
-                if phase == "lint":
-                    cont &= tactic.lint()
-                    if cont is False and self.force is not True:
-                        break
-                elif phase == "read":
-                    # We use a read (into memory phase to make layer comps
-                    # simpler)
-                    tactic.read()
-                elif phase == "__call__":
-                    tactic()
-                elif phase == "sign":
-                    sig = tactic.sign()
-                    if sig:
-                        signatures.update(sig)
+        signatures = self.run_plan(plan)
         # write out the sigs
         self.write_signatures(signatures, layers)
 
+    def run_plan(self, plan):
+        """Lint, read, run and sign the tactics of plan, returning their
+        signatures"""
+        signatures = {}
+        if self.digests is None:
+            # shared by every tactic so each output file is hashed once
+            self.digests = utils.DigestRegistry()
+        # pip installs and the like run concurrently, landing in plan
+        # order before anything else writes where they land and at the
+        # latest before signing
+        pending = []
+        with utils.ProcessPool(self.jobs) as pool:
+            for phase in ['lint', 'read', '__call__', 'sign']:
+                if phase == "lint":
+                    self.lint(plan)
+                    continue
+                for tactic in plan:
+                    if phase == "read":
+                        # We use a read (into memory phase to make layer
+                        # comps simpler)
+                        tactic.read()
+                    elif phase == "__call__":
+                        last = max([i + 1 for i, t in enumerate(pending)
+                                    if tactic.writes_to(t.pending())] or
+                                   [0])
+                        for earlier in pending[:last]:
+                            earlier.settle()
+                        del pending[:last]
+                        tactic.pool = pool
+                        tactic()
+                        if tactic.pending() is not None:
+                            pending.append(tactic)
+                    elif phase == "sign":
+                        # an attribute, layer tactics may override sign()
+                        # without taking digests
+                        tactic.digests = self.digests
+                        sig = tactic.sign()
+                        if sig:
+                            signatures.update(sig)
+                if phase == "__call__":
+                    for tactic in pending:
+                        tactic.settle()
+                    del pending[:]
+        return signatures
+
+    def lint(self, plan):
+        """Run every tactic's lint and diff all their lint targets in
+        parallel, returning True if everything passed"""
+        cont = True
+        for tactic in plan:
+            cont &= tactic.lint()
+        pairs = [pair for tactic in plan for pair in tactic.lint_targets()]
+        cont &= lint.lint_files(pairs, jobs=self.jobs,
+                                backend=self.diff_backend,
+                                mode=self.lint_mode,
+                                cache=lint.LintCache(utils.cache_dir("lint")),
+                                digests=self.digests)
+        return cont
+
     def write_signatures(self, signatures, layers):
         sigs = self.target / ".composer.manifest"
         signatures['.composer.manifest'] = ["composer", 'dynamic', 'unchecked']
-        sigs.write_text(json.dumps(dict(
-            signatures=signatures,
-            layers=layers,
-        ), indent=2))
+        manifest = Manifest.from_signatures(self.target.directory,
+                                            signatures, layers)
+        manifest.write(sigs)
+        self.manifest = manifest
 
     def generate(self):
+        if self.digests is None:
+            self.digests = utils.DigestRegistry()
         layers = self.fetch()
+        build_cache = remote = key = None
+        if self.cache_server:
+            remote = cache.RemoteCache(self.cache_server)
+        if self.build_cache or remote:
+            build_cache = cache.BuildCache(
+                utils.cache_dir("build"),
+                max_size=self.build_cache_size * 1024 * 1024)
+            key = cache.build_key(layers, self.digests)
+            manifest = build_cache.restore(key, self.target_dir)
+            if manifest is None and remote and remote.fetch(key, build_cache):
+                manifest = build_cache.restore(key, self.target_dir)
+            if manifest is not None:
+                log.info("Restored cached build %s", key)
+                manifest.write(self.target_dir / ".composer.manifest")
+                self.manifest = manifest
+                self._layer_configs = []
+                return
+        previous = self.target_dir / ".composer.manifest"
+        if previous.exists():
+            # outputs restored from the cache may be hardlinked to it
+            cache.break_hardlinks(self.target_dir,
+                                  Manifest.load(previous).signatures)
         self.formulate_plan(layers)
         self.exec_plan(self.plan, self.layers)
+        if build_cache:
+            build_cache.store(key, self.target_dir, self.manifest)
+            if remote:
+                remote.push(key, build_cache)
 
     def validate(self):
         p = self.target_dir / ".composer.manifest"
         if not p.exists():
             return [], [], []
         ignorer = utils.ignore_matcher(DEFAULT_IGNORES)
-        a, c, d = utils.delta_signatures(p, ignorer)
+        digests = utils.PersistentDigestRegistry.for_directory(
+            self.target_dir)
+        a, c, d = Manifest.load(p).delta(self.target_dir, ignorer,
+                                         digests=digests,
+                                         quick=self.quick, jobs=self.jobs)
+        digests.save()
 
         for f in a:
             log.warn(
@@ -334,8 +457,131 @@ class Composer(object):
         self.validate()
         self.generate()
 
+    def expand(self, relpaths):
+        """relpaths with directories standing for the files under them in
+        the layers or recorded in the manifest"""
+        result = set()
+        for rel in relpaths:
+            prefix = rel + "/"
+            result.update(r for r in self.manifest.signatures
+                          if r.startswith(prefix))
+            for layer, config in self._layer_configs:
+                d = layer.directory / rel
+                if d.isdir():
+                    result.update(f.relpath(layer.directory)
+                                  for f in d.walkfiles())
+            result.add(rel)
+        return result
+
+    def update(self, relpaths):
+        """Recompose just relpaths of the layers, re-running the tactics
+        of every layer providing them and re-signing only the manifest
+        entries they touch. Returns False when the change calls for a
+        full build instead"""
+        if not self._layer_configs or ComposerConfig.DEFAULT_FILE in relpaths:
+            # includes, ignores and tactics may all have changed
+            return False
+        relpaths = self.expand(relpaths)
+        output_files = self.plan_paths(relpaths)
+        signatures = self.run_plan([t for t in output_files.values() if t])
+        if "metadata.yaml" in relpaths:
+            # rebinding interfaces is left to a full build
+            meta = output_files.get("metadata.yaml")
+            specs = relation_specs(meta.data) if meta and meta.data else []
+            if specs != (self._relations or []):
+                return False
+        urls = set(layer.url for layer in self._layers)
+        removed = [rel for rel in relpaths
+                   if rel not in signatures and rel in self.manifest and
+                   self.manifest[rel].layer in urls]
+        for rel in removed:
+            (self.target_dir / rel).remove_p()
+        self.manifest.update(self.target_dir, signatures, removed)
+        self.manifest.write(self.target / ".composer.manifest")
+        log.info("Updated %s", ", ".join(sorted(set(signatures) |
+                                               set(removed))) or "nothing")
+        return True
+
+    def watched(self):
+        """The directories of the layers and interfaces of the last build"""
+        return [e.directory for e in self._layers + self._interfaces]
+
+    def layer_relpaths(self, changed):
+        """Map the changed paths to relpaths of the layers, None when the
+        change calls for a full build"""
+        if changed is None:
+            return None
+        relpaths = set()
+        target = self.target_dir.abspath()
+        for p in changed:
+            p = path(p).abspath()
+            if p == target or p.startswith(target + os.sep):
+                continue
+            for iface in self._interfaces:
+                d = iface.directory.abspath()
+                if p == d or p.startswith(d + os.sep):
+                    return None
+            for layer in self._layers:
+                d = layer.directory.abspath()
+                if p == d:
+                    return None
+                if p.startswith(d + os.sep):
+                    relpaths.add(str(d.relpathto(p)))
+        return relpaths
+
+    def watch_layers(self, stop=None, interval=1.0):
+        """Compose, then recompose as the layers change until interrupted
+        or the stop threading.Event is set. Changes are applied through
+        update, falling back to a full build when needed."""
+        if self.resolved is None:
+            self.resolved = {}
+        self()
+        while not (stop and stop.is_set()):
+            watcher = watch.watcher(self.watched(), interval)
+            log.info("Watching %d layers for changes", len(self.watched()))
+            try:
+                for changed in watch.batches(watcher, timeout=interval):
+                    if stop and stop.is_set():
+                        return
+                    relpaths = self.layer_relpaths(changed)
+                    if relpaths is not None and not relpaths:
+                        continue
+                    full = relpaths is None
+                    try:
+                        if not full:
+                            full = not self.update(relpaths)
+                        if full:
+                            log.info("Recomposing %s", self.target_dir)
+                            self.generate()
+                    except Exception:
+                        log.exception("Composing failed, waiting for the "
+                                      "next change")
+                    finally:
+                        # a rewrite within the same mtime tick would go
+                        # unnoticed
+                        self.digests.forget_recent(
+                            utils.PersistentDigestRegistry.RACY)
+                    if full:
+                        # the layers may have changed, watch them afresh
+                        break
+            finally:
+                watcher.close()
+
     def inspect(self):
-        inspector.inspect(self.charm)
+        inspector.inspect(self.charm, verify=self.verify,
+                          format=self.format, stats=self.stats,
+                          subdir=self.subdir, depth=self.depth)
+
+
+def relation_specs(meta):
+    """The [kind, relation name, interface] of each relation of a charm's
+    metadata"""
+    specs = []
+    for kind in ("provides", "requires", "peer"):
+        for k, v in meta.get(kind, {}).items():
+            # ex: ["provides", "db", "mysql"]
+            specs.append([kind, k, v["interface"]])
+    return specs
 
 
 def configLogging(composer):
@@ -369,23 +615,72 @@ def normalize_outputdir(composer):
     return od
 
 
-def inspect(args=None):
-    composer = Composer()
+def inspect_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--log-level', default=logging.INFO)
+    parser.add_argument('--no-verify', dest="verify", action="store_false",
+                        help="Don't check for files changed since the "
+                        "charm was composed")
+    parser.add_argument('--format', choices=("text", "json"), default="text",
+                        help="text renders a tree, json streams a record "
+                        "per file followed by per layer statistics")
+    parser.add_argument('--stats', action="store_true",
+                        help="Include per layer size statistics in the "
+                        "text output")
+    parser.add_argument('--path', dest="subdir",
+                        help="Only inspect this directory of the charm")
+    parser.add_argument('--depth', type=int,
+                        help="Only descend this many levels")
     parser.add_argument('charm', default=".", type=path)
+    return parser
+
+
+def setup_inspect(composer, args):
     # Namespace will set the options as attrs of composer
-    parser.parse_args(args, namespace=composer)
+    inspect_parser().parse_args(args, namespace=composer)
     configLogging(composer)
-    composer.inspect()
+    return composer
 
 
-def main(args=None):
-    composer = Composer()
-    parser = argparse.ArgumentParser()
+def inspect(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    code = daemon.forward("inspect", args)
+    if code is not None:
+        sys.exit(code)
+    setup_inspect(Composer(), args).inspect()
+
+
+def compose_parser():
+    parser = argparse.ArgumentParser(
+        epilog="Run 'juju-compose serve' to keep a server with warm caches "
+        "that later invocations forward to")
     parser.add_argument('-l', '--log-level', default=logging.INFO)
     parser.add_argument('-f', '--force', action="store_true")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Number of parallel jobs, defaults to the "
+                        "number of CPUs")
+    parser.add_argument('--diff-backend', choices=list(diff.BACKENDS),
+                        help="Diff implementation used to lint interface "
+                        "modules, defaults to dmp")
+    parser.add_argument('--lint-mode', choices=lint.MODES, default="diff",
+                        help="Compare interface modules by text diff or by "
+                        "their parsed reactive handlers")
+    parser.add_argument('--quick', action="store_true",
+                        help="Stop validating the existing output at the "
+                        "first unexpected change")
     parser.add_argument('-o', '--output-dir')
+    parser.add_argument('--build-cache', action="store_true",
+                        help="Reuse outputs of identical builds from "
+                        "the local build cache")
+    parser.add_argument('--build-cache-size', type=int, default=1024,
+                        help="Size limit of the build cache in MB")
+    parser.add_argument('--cache-server',
+                        help="URL of a shared build cache server, "
+                        "implies --build-cache")
+    parser.add_argument('--watch', action="store_true",
+                        help="Keep recomposing the changed files as the "
+                        "layers change")
     parser.add_argument('-s', '--series', default="trusty")
     parser.add_argument('--interface-service',
                         default="http://localhost:9999")
@@ -393,18 +688,41 @@ def main(args=None):
                         default=path(os.getcwd).dirname(),
                         help="Generate a charm of 'name' from 'charm'")
     parser.add_argument('charm', nargs="?", default=".", type=path)
+    return parser
+
+
+def setup(composer, args):
     # Namespace will set the options as attrs of composer
-    parser.parse_args(args, namespace=composer)
+    compose_parser().parse_args(args, namespace=composer)
     # Monkey patch in the domain for the interface webservice
-    InterfaceFetcher.INTERFACE_DOMAIN = composer.interface_service
-    LayerFetcher.INTERFACE_DOMAIN = composer.interface_service
+    fetchers.InterfaceFetcher.INTERFACE_DOMAIN = composer.interface_service
+    fetchers.LayerFetcher.INTERFACE_DOMAIN = composer.interface_service
     configLogging(composer)
 
     if not composer.name:
         composer.name = path(composer.charm).normpath().name
     if not composer.output_dir:
         normalize_outputdir(composer)
-    composer()
+    return composer
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ["serve"]:
+        return daemon.main(args[1:])
+    if "--watch" not in args:
+        code = daemon.forward("compose", args)
+        if code is not None:
+            sys.exit(code)
+    composer = setup(Composer(), args)
+    if composer.watch:
+        try:
+            composer.watch_layers()
+        except KeyboardInterrupt:
+            pass
+    else:
+        composer()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,480 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import stat
+import tempfile
+import time
+from contextlib import contextmanager
+
+from path import path
+import lazy
+import utils
+from config import DEFAULT_IGNORES
+from manifest import Entry, Manifest
+
+requests = lazy.LazyModule("requests")
+
+log = logging.getLogger("composer")
+
+# ioctl(2) request to clone a file's extents (btrfs, xfs)
+FICLONE = 0x40049409
+
+SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+_tool_fingerprint = None
+
+
+def tool_fingerprint():
+    """Digest of the composer sources, changes to the tool invalidate
+    cached builds"""
+    global _tool_fingerprint
+    if _tool_fingerprint is None:
+        h = hashlib.sha256()
+        for fn in sorted(path(__file__).dirname().files('*.py')):
+            h.update(fn.name)
+            h.update(fn.bytes())
+        _tool_fingerprint = h.hexdigest()
+    return _tool_fingerprint
+
+
+def tree_digest(directory, digests=None, ignores=DEFAULT_IGNORES):
+    """Digest of the relpath, mode and content of every file in directory"""
+    if digests is None:
+        digests = utils.sign
+    directory = path(directory)
+    ignorer = utils.ignore_matcher(ignores)
+    h = hashlib.sha256()
+    for entry in sorted(directory.walkfiles()):
+        rel = entry.relpath(directory)
+        if not ignorer(rel):
+            continue
+        h.update("{}\0{:o}\0{}\n".format(
+            rel, stat.S_IMODE(entry.stat().st_mode), digests(entry)))
+    return h.hexdigest()
+
+
+def build_key(layers, digests=None):
+    """Compute the key for the output of composing layers.
+
+    layers is the result of Composer.fetch, the key covers the tool
+    version, the content of every layer and interface in order and the
+    chain of composer.yaml files.
+    """
+    h = hashlib.sha256()
+    h.update("tool\0{}\n".format(tool_fingerprint()))
+    for kind in ("layers", "interfaces"):
+        for layer in layers[kind]:
+            h.update("{}\0{}\0{}\n".format(
+                kind, layer.url, tree_digest(layer.directory, digests)))
+            config = layer.directory / layer.CONFIG_FILE
+            if config.exists():
+                h.update(config.bytes())
+    return h.hexdigest()
+
+
+def check_relpath(rel):
+    """Raise ValueError unless rel is a relative path staying inside the
+    directory it is joined to"""
+    if not isinstance(rel, basestring) or not rel:
+        raise ValueError("Invalid path {!r} in build record".format(rel))
+    if posixpath.isabs(rel) or os.path.isabs(rel) or "\0" in rel or \
+            ".." in rel.replace("\\", "/").split("/"):
+        raise ValueError("Unsafe path {!r} in build record".format(rel))
+    return rel
+
+
+def check_record(record):
+    """Raise ValueError on the first file of a build record with an unsafe
+    path or an invalid sha256"""
+    try:
+        files = record['files']
+        for entry in files:
+            check_relpath(entry[0])
+            if not isinstance(entry[3], basestring) or \
+                    not SHA256.match(entry[3]):
+                raise ValueError("Invalid sha256 {!r} in build record".format(
+                    entry[3]))
+    except (KeyError, IndexError, TypeError) as e:
+        raise ValueError("Malformed build record: {}".format(e))
+    return record
+
+
+def _contained(directory, rel):
+    """directory / rel, raising ValueError if it isn't under directory"""
+    target = (directory / rel).normpath()
+    if target != directory and not target.startswith(directory + os.sep):
+        raise ValueError("{} escapes {}".format(rel, directory))
+    return target
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class BuildCache(object):
+    """Local content addressed store of composed charms.
+
+    Files are stored once under blobs/ by sha256 and each build is a
+    record under builds/<key>.json listing the files of the output. A hit
+    restores the output by reflinking each blob where the filesystem
+    supports it, hardlinking otherwise, and copying as a last resort.
+    Builds are evicted least recently used first once the blobs exceed
+    max_size bytes.
+
+    Writers hold a shared lock on the store while they add blobs and
+    records, pruning takes it exclusively. Pruning runs at most every
+    PRUNE_INTERVAL seconds and keeps orphaned blobs younger than GRACE
+    seconds, which may be uploads whose record hasn't arrived yet.
+    """
+    PRUNE_INTERVAL = 600
+    GRACE = 3600
+
+    def __init__(self, root, max_size=1024 * 1024 * 1024):
+        self.root = path(root)
+        self.max_size = max_size
+        self.blobs = self.root / "blobs"
+        self.builds = self.root / "builds"
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        self.root.makedirs_p()
+        with open(self.root / ".lock", "a") as fp:
+            fcntl.flock(fp.fileno(),
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def blob_path(self, sha):
+        return self.blobs / sha[:2] / sha
+
+    def record_path(self, key):
+        return self.builds / "{}.json".format(key)
+
+    def _atomic_write(self, target, data):
+        target.dirname().makedirs_p()
+        fd, tmp = tempfile.mkstemp(dir=target.dirname())
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp, target)
+
+    def has_blob(self, sha):
+        return self.blob_path(sha).exists()
+
+    def blob_fingerprint(self, sha):
+        return list(utils.stat_fingerprint(self.blob_path(sha).stat())[:2])
+
+    def verify_blob(self, sha, fingerprint):
+        """Check blob sha is intact. Restored outputs may be hardlinks to
+        the blob, writing to them changes its mtime, so only blobs whose
+        (size, mtime_ns) moved are re-hashed. Damaged blobs are removed."""
+        blob = self.blob_path(sha)
+        try:
+            current = self.blob_fingerprint(sha)
+        except OSError:
+            return False
+        if current == fingerprint:
+            return True
+        if utils.sign(blob) == sha:
+            return True
+        log.warn("Removing modified blob %s from the build cache", sha)
+        blob.remove_p()
+        return False
+
+    def add_blob(self, sha, source):
+        """Copy source into the store as blob sha"""
+        blob = self.blob_path(sha)
+        if blob.exists():
+            return blob
+        blob.dirname().makedirs_p()
+        fd, tmp = tempfile.mkstemp(dir=blob.dirname())
+        os.close(fd)
+        shutil.copy2(source, tmp)
+        os.rename(tmp, blob)
+        return blob
+
+    def add_blob_chunks(self, sha, chunks):
+        """Store the data from an iterable of chunks as blob sha, raising
+        ValueError if it doesn't hash to sha"""
+        blob = self.blob_path(sha)
+        blob.dirname().makedirs_p()
+        h = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=blob.dirname())
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in chunks:
+                    h.update(chunk)
+                    fp.write(chunk)
+            if h.hexdigest() != sha:
+                raise ValueError("Blob data doesn't match {}".format(sha))
+            os.chmod(tmp, 0644)
+            os.rename(tmp, blob)
+        finally:
+            path(tmp).remove_p()
+        return blob
+
+    def get(self, key):
+        """Return the build record for key or None"""
+        record = self.record_path(key)
+        if not record.exists():
+            return None
+        return json.loads(record.text())
+
+    def put(self, key, record):
+        check_record(record)
+        self._atomic_write(self.record_path(key), json.dumps(record))
+
+    def store(self, key, directory, manifest):
+        """Add the output in directory, described by manifest, as key"""
+        directory = path(directory)
+        files = []
+        with self.lock():
+            for rel, e in sorted(manifest.signatures.items()):
+                if e.layer == "composer":
+                    continue
+                check_relpath(rel)
+                fn = directory / rel
+                if not fn.isfile():
+                    continue
+                self.add_blob(e.sha256, fn)
+                files.append([rel, e.layer, e.kind, e.sha256,
+                              stat.S_IMODE(fn.stat().st_mode),
+                              self.blob_fingerprint(e.sha256)])
+            self.put(key, dict(layers=manifest.layers, files=files))
+        self.maybe_prune()
+
+    def restore(self, key, directory):
+        """Materialize build key into directory, returning its Manifest or
+        None if the build isn't cached"""
+        record = self.get(key)
+        if record is None:
+            return None
+        try:
+            check_record(record)
+        except ValueError as e:
+            log.warn("Ignoring cached build %s: %s", key, e)
+            return None
+        directory = path(directory).abspath().normpath()
+        with self.lock():
+            return self._restore(key, record, directory)
+
+    def _restore(self, key, record, directory):
+        for rel, layer, kind, sha, mode, fingerprint in record['files']:
+            if not self.verify_blob(sha, fingerprint):
+                log.debug("Cached build %s is missing blob %s", key, sha)
+                return None
+        sigs = {}
+        real = directory.realpath()
+        for rel, layer, kind, sha, mode, fingerprint in record['files']:
+            try:
+                target = _contained(directory, rel)
+                # directories already in the output may be symlinks
+                _contained(real, real.relpathto(target.dirname().realpath()))
+            except ValueError as e:
+                log.warn("Ignoring cached build %s: %s", key, e)
+                return None
+            target.dirname().makedirs_p()
+            target.remove_p()
+            self.materialize(sha, target, mode)
+            size, mtime_ns, _ = utils.stat_fingerprint(target.stat())
+            sigs[rel] = Entry(layer, kind, sha, size, mtime_ns)
+        sigs[".composer.manifest"] = Entry("composer", "dynamic",
+                                           "unchecked", None, None)
+        # bump the record for LRU eviction, it may have been evicted since
+        # we read it
+        try:
+            self.record_path(key).utime(None)
+        except OSError:
+            pass
+        return Manifest(record['layers'], sigs)
+
+    def materialize(self, sha, target, mode):
+        blob = self.blob_path(sha)
+        try:
+            _reflink(blob, target)
+            target.chmod(mode)
+            return
+        except (IOError, OSError):
+            target.remove_p()
+        if stat.S_IMODE(blob.stat().st_mode) == mode:
+            try:
+                os.link(blob, target)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        shutil.copy2(blob, target)
+        target.chmod(mode)
+
+    def maybe_prune(self):
+        """Prune unless that was done in the last PRUNE_INTERVAL seconds"""
+        stamp = self.root / ".pruned"
+        try:
+            if time.time() - stamp.mtime < self.PRUNE_INTERVAL:
+                return False
+        except OSError:
+            pass
+        self.prune()
+        return True
+
+    def prune(self, grace=None):
+        """Evict least recently used builds until the blobs referenced by
+        the remaining builds fit in max_size, then drop orphaned blobs
+        older than grace seconds (GRACE by default)"""
+        with self.lock(exclusive=True):
+            (self.root / ".pruned").touch()
+            self._prune(self.GRACE if grace is None else grace)
+
+    def _prune(self, grace):
+        if not self.builds.exists():
+            return
+        records = sorted(self.builds.files("*.json"),
+                         key=lambda r: r.mtime)
+        refs = {}
+        files = {}
+        for record in records:
+            shas = set(f[3] for f in json.loads(record.text())['files'])
+            files[record] = shas
+            for sha in shas:
+                refs[sha] = refs.get(sha, 0) + 1
+        sizes = {}
+        recent = set()
+        cutoff = time.time() - grace
+        if self.blobs.exists():
+            for blob in self.blobs.walkfiles():
+                # skip blobs still being written
+                if blob.name.startswith("tmp"):
+                    continue
+                st = blob.stat()
+                sizes[blob.name] = st.st_size
+                # copies keep their source's mtime, renaming sets ctime
+                if max(st.st_mtime, st.st_ctime) > cutoff:
+                    recent.add(blob.name)
+        total = sum(size for sha, size in sizes.items() if sha in refs)
+        for record in records:
+            if total <= self.max_size:
+                break
+            log.debug("Evicting cached build %s", record.namebase)
+            record.remove_p()
+            for sha in files[record]:
+                refs[sha] -= 1
+                if not refs[sha]:
+                    total -= sizes.get(sha, 0)
+        for sha in sizes:
+            if not refs.get(sha) and sha not in recent:
+                self.blob_path(sha).remove_p()
+
+
+def break_hardlinks(directory, relpaths):
+    """Replace files with more than one link by private copies so that
+    writing to them can't change a cached blob"""
+    directory = path(directory)
+    for rel in relpaths:
+        fn = directory / rel
+        try:
+            st = fn.lstat()
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+            fd, tmp = tempfile.mkstemp(dir=fn.dirname())
+            os.close(fd)
+            shutil.copy2(fn, tmp)
+            os.rename(tmp, fn)
+
+
+class RemoteCache(object):
+    """Client for a shared build cache server (see cacheserver).
+
+    The protocol is plain HTTP:
+
+        GET/PUT /builds/<key>     build record as JSON
+        GET/PUT /blobs/<sha256>   file contents
+        POST /blobs/missing       JSON list of sha256, returns those the
+                                  server doesn't have
+
+    Build records exchanged with the server list [relpath, layer, kind,
+    sha256, mode] for each file. Network failures are logged and treated
+    as a miss, the build carries on locally.
+    """
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _url(self, *parts):
+        return "/".join((self.url,) + parts)
+
+    def get(self, key):
+        r = requests.get(self._url("builds", key), timeout=self.timeout)
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return r.json()
+
+    def put(self, key, record):
+        requests.put(self._url("builds", key), data=json.dumps(record),
+                     timeout=self.timeout).raise_for_status()
+
+    def missing(self, shas):
+        r = requests.post(self._url("blobs", "missing"),
+                          data=json.dumps(sorted(shas)),
+                          timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def download(self, sha, local):
+        r = requests.get(self._url("blobs", sha), stream=True,
+                         timeout=self.timeout)
+        r.raise_for_status()
+        return local.add_blob_chunks(sha, r.iter_content(65536))
+
+    def upload(self, sha, local):
+        with open(local.blob_path(sha), 'rb') as fp:
+            requests.put(self._url("blobs", sha), data=fp,
+                         timeout=self.timeout).raise_for_status()
+
+    def fetch(self, key, local):
+        """Copy build key from the server into the local cache, downloading
+        only the blobs it is missing. Returns True if the build was found.
+        """
+        try:
+            record = self.get(key)
+            if record is None:
+                return False
+            check_record(record)
+            files = []
+            for entry in record['files']:
+                sha = entry[3]
+                if not local.has_blob(sha):
+                    self.download(sha, local)
+                files.append(entry[:5] + [local.blob_fingerprint(sha)])
+        except (requests.RequestException, ValueError) as e:
+            log.warn("Unable to fetch build %s from %s: %s",
+                     key, self.url, e)
+            return False
+        local.put(key, dict(layers=record['layers'], files=files))
+        return True
+
+    def push(self, key, local):
+        """Send build key from the local cache to the server, uploading
+        only the blobs the server is missing"""
+        record = local.get(key)
+        if record is None:
+            return
+        try:
+            shas = set(entry[3] for entry in record['files'])
+            for sha in self.missing(shas):
+                self.upload(sha, local)
+            self.put(key, dict(
+                layers=record['layers'],
+                files=[entry[:5] for entry in record['files']]))
+        except requests.RequestException as e:
+            log.warn("Unable to push build %s to %s: %s", key, self.url, e)
@@ -0,0 +1,146 @@
+"""Reference server for sharing composed charms between build agents.
+
+See cache.RemoteCache for the protocol. Blobs and build records are kept
+in a BuildCache so the same size limit and eviction apply.
+"""
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import SocketServer
+
+import utils
+from cache import BuildCache, SHA256, check_record
+
+log = logging.getLogger("composer.cacheserver")
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    CHUNK = 65536
+
+    def _route(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] in ("builds", "blobs"):
+            return parts
+        return None, None
+
+    def _reply(self, code, body="", content_type="application/json"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.getheader("Content-Length", 0))
+        while length > 0:
+            chunk = self.rfile.read(min(self.CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    def do_GET(self):
+        kind, name = self._route()
+        cache = self.server.cache
+        if kind is None or not SHA256.match(name):
+            return self._reply(404)
+        if kind == "builds":
+            record = cache.get(name)
+            if record is None:
+                return self._reply(404)
+            return self._reply(200, json.dumps(record))
+        if not cache.has_blob(name):
+            return self._reply(404)
+        blob = cache.blob_path(name)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(blob.size))
+        self.end_headers()
+        with open(blob, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(self.CHUNK), ""):
+                self.wfile.write(chunk)
+
+    def do_PUT(self):
+        kind, name = self._route()
+        cache = self.server.cache
+        if kind is None or not SHA256.match(name):
+            return self._reply(404)
+        if kind == "builds":
+            try:
+                record = check_record(json.loads("".join(self._body())))
+                with cache.lock():
+                    for entry in record['files']:
+                        if not cache.has_blob(entry[3]):
+                            raise ValueError(
+                                "missing blob {}".format(entry[3]))
+                    cache.put(name, record)
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                return self._reply(400, json.dumps(str(e)))
+            cache.maybe_prune()
+            return self._reply(201)
+        if cache.has_blob(name):
+            # drain the upload, we already have it
+            for chunk in self._body():
+                pass
+            return self._reply(200)
+        try:
+            cache.add_blob_chunks(name, self._body())
+        except ValueError as e:
+            return self._reply(400, json.dumps(str(e)))
+        return self._reply(201)
+
+    def do_POST(self):
+        if self.path.strip("/") != "blobs/missing":
+            return self._reply(404)
+        try:
+            shas = json.loads("".join(self._body()))
+        except ValueError as e:
+            return self._reply(400, json.dumps(str(e)))
+        cache = self.server.cache
+        missing = [sha for sha in shas
+                   if SHA256.match(sha) and not cache.has_blob(sha)]
+        self._reply(200, json.dumps(missing))
+
+    def log_message(self, fmt, *args):
+        log.debug("%s %s", self.address_string(), fmt % args)
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.cache = cache
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Share composed charms between build agents")
+    parser.add_argument('-l', '--log-level', default=logging.INFO)
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('-p', '--port', type=int, default=8900)
+    parser.add_argument('-d', '--directory', default=utils.cache_dir("server"))
+    parser.add_argument('--max-size', type=int, default=10240,
+                        help="Size limit of the stored blobs in MB")
+    options = parser.parse_args(args)
+    if isinstance(options.log_level, str):
+        options.log_level = options.log_level.upper()
+    logging.basicConfig(level=options.log_level)
+    server = CacheServer((options.host, options.port),
+                         BuildCache(options.directory,
+                                    options.max_size * 1024 * 1024))
+    log.info("Serving build cache %s on %s", options.directory, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,14 @@
+from .plugins import plugin_tactics
 from .tactics import DEFAULT_TACTICS, load_tactic
 
 
-import pathspec
-from ruamel import yaml
 import logging
 from path import path
 from otherstuf import chainstuf
+from . import lazy
+from . import utils
+
+yaml = lazy.LazyModule("ruamel.yaml")
 
 DEFAULT_IGNORES = [
     ".bzr/",
@@ -51,7 +54,7 @@ class ComposerConfig(chainstuf):
             raise OSError("Missing Config File {}".format(config_file))
         try:
             if config_file.exists():
-                data = yaml.load(config_file.open())
+                data = utils.load_document(config_file, yaml.load)
                 self.configured = True
         except yaml.parser.ParserError:
             logging.critical("Malformed Config file: {}".format(config_file))
@@ -88,7 +91,8 @@ class ComposerConfig(chainstuf):
 
     def tactics(self):
         # XXX: combine from config layer
-        return self.rget('_tactics') + DEFAULT_TACTICS
+        # layer tactics win over installed ones, which win over defaults
+        return self.rget('_tactics') + plugin_tactics() + DEFAULT_TACTICS
 
     def tactic(self, entity, current, target, next_config):
         # Produce a tactic for the entity in question
@@ -97,8 +101,7 @@ class ComposerConfig(chainstuf):
         bd = current.directory
         # Ignore handling
         if next_config:
-            spec = pathspec.PathSpec.from_lines(pathspec.GitIgnorePattern,
-                                                next_config.ignores)
+            spec = utils.ignore_spec(next_config.ignores)
             p = entity.relpath(bd)
             matches = spec.match_files((p,))
             if p in matches:
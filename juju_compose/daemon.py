@@ -0,0 +1,270 @@
+"""Long running juju-compose keeping its caches warm between builds.
+
+    juju-compose serve [--socket PATH]
+
+listens on a Unix socket, by default compose.sock in the user cache, for
+one JSON line request per connection:
+
+    {"command": "compose", "args": ["-o", "out", "trusty/tester"],
+     "cwd": "/home/me/charms", "env": {"COMPOSER_PATH": "..."}}
+
+where command is compose, validate or inspect and args are the command
+line arguments of juju-compose (or juju-inspect). The reply streams JSON
+lines of {"stdout": text} and {"stderr": text} as the command runs,
+followed by a final {"exit": code}.
+
+Requests are handled one at a time. Between them the server keeps file
+digests, parsed YAML and JSON documents and the directories layers and
+interfaces resolved to, so remote layers aren't fetched again until the
+server is restarted. juju-compose and juju-inspect forward their
+arguments to a server listening on the socket and run in process when
+there is none.
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import traceback
+
+from path import path
+import utils
+
+log = logging.getLogger("composer.daemon")
+
+# environment the client's build depends on
+ENVIRON = ("JUJU_REPOSITORY", "COMPOSER_PATH", "INTERFACE_PATH")
+
+
+def socket_path():
+    return os.environ.get("COMPOSER_SOCKET") or utils.cache_dir("compose.sock")
+
+
+class StreamWriter(object):
+    """File like object sending what's written as {name: text} lines"""
+    def __init__(self, send, name):
+        self.send = send
+        self.name = name
+
+    def write(self, text):
+        if text:
+            self.send({self.name: text})
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class ComposeRequestHandler(SocketServer.StreamRequestHandler):
+    def send(self, message):
+        if self.closed:
+            return
+        try:
+            self.wfile.write(json.dumps(message) + "\n")
+            self.wfile.flush()
+        except socket.error:
+            # the client went away, finish the request regardless
+            self.closed = True
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def handle(self):
+        self.closed = False
+        try:
+            request = json.loads(self.rfile.readline())
+            command = self.server.commands[request["command"]]
+            args = [a.encode("utf-8") for a in request.get("args", [])]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send({"stderr": "Malformed request: {}\n".format(e)})
+            return self.send({"exit": 2})
+        log.info("%s %s", request["command"], " ".join(args))
+        code = self.server.run(command, args, request.get("cwd"),
+                               request.get("env") or {}, self.send)
+        self.send({"exit": code})
+
+
+def _compose(server, args):
+    import juju_compose
+    juju_compose.setup(server.composer(), args)()
+
+
+def _validate(server, args):
+    import juju_compose
+    composer = juju_compose.setup(server.composer(), args)
+    composer.find_or_create_repo()
+    return 1 if any(composer.validate()) else 0
+
+
+def _inspect(server, args):
+    import juju_compose
+    juju_compose.setup_inspect(server.composer(), args).inspect()
+
+
+class ComposeServer(SocketServer.UnixStreamServer):
+    """Serves requests serially, keeping caches between them"""
+    commands = {
+        "compose": _compose,
+        "validate": _validate,
+        "inspect": _inspect,
+    }
+
+    def __init__(self, address):
+        SocketServer.UnixStreamServer.__init__(self, address,
+                                               ComposeRequestHandler)
+        os.chmod(address, 0600)
+        self.digests = utils.DigestRegistry()
+        self.documents = utils.DocumentCache()
+        self.resolved = {}
+
+    def composer(self):
+        """A Composer sharing the warm caches"""
+        import juju_compose
+        composer = juju_compose.Composer()
+        composer.digests = self.digests
+        composer.resolved = self.resolved
+        return composer
+
+    def run(self, command, args, cwd, env, send):
+        """Run command(self, args) as if from a client in cwd with env,
+        its output sent through send. Returns the exit code"""
+        root = logging.getLogger()
+        saved = (os.getcwd(), dict(os.environ), sys.stdout, sys.stderr,
+                 root.handlers[:], root.level, utils.documents)
+        try:
+            if cwd:
+                os.chdir(cwd)
+            for key in ENVIRON:
+                if key in env:
+                    os.environ[key] = env[key]
+                else:
+                    os.environ.pop(key, None)
+            sys.stdout = StreamWriter(send, "stdout")
+            sys.stderr = StreamWriter(send, "stderr")
+            utils.documents = self.documents
+            try:
+                return command(self, args) or 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                sys.stderr.write("{}\n".format(e.code))
+                return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+        finally:
+            (cwd, environ, sys.stdout, sys.stderr,
+             root.handlers[:], level, utils.documents) = saved
+            root.setLevel(level)
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+            # a rewrite within the same mtime tick would go unnoticed
+            racy = utils.PersistentDigestRegistry.RACY
+            self.digests.forget_recent(racy)
+            self.documents.forget_recent(racy)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def _connect(address):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def forward(command, args, address=None, stdout=None, stderr=None):
+    """Run command with args on the server listening at address, copying
+    its output to stdout and stderr (ours by default). Returns its exit
+    code, or None when no server is listening"""
+    address = address or socket_path()
+    outputs = (("stdout", stdout or sys.stdout),
+               ("stderr", stderr or sys.stderr))
+    if not os.path.exists(address):
+        return None
+    sock = _connect(address)
+    if sock is None:
+        return None
+    request = {
+        "command": command,
+        "args": list(args),
+        "cwd": os.getcwd(),
+        "env": dict((k, os.environ[k]) for k in ENVIRON if k in os.environ),
+    }
+    try:
+        sock.sendall(json.dumps(request) + "\n")
+        for line in sock.makefile("rb"):
+            message = json.loads(line)
+            for name, fp in outputs:
+                if name in message:
+                    fp.write(message[name].encode("utf-8"))
+                    fp.flush()
+            if "exit" in message:
+                return message["exit"]
+    finally:
+        sock.close()
+    outputs[1][1].write("Lost the connection to the compose server\n")
+    return 1
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="juju-compose serve",
+        description="Serve juju-compose requests keeping caches warm")
+    parser.add_argument('-l', '--log-level', default=logging.INFO)
+    parser.add_argument('--socket', default=socket_path(),
+                        help="Path of the Unix socket to listen on")
+    options = parser.parse_args(args)
+    if isinstance(options.log_level, str):
+        options.log_level = options.log_level.upper()
+    # kept apart from the root logger, which requests configure
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(name)s: %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(options.log_level)
+    log.propagate = False
+
+    address = options.socket
+    if os.path.exists(address):
+        sock = _connect(address)
+        if sock is not None:
+            sock.close()
+            parser.error("Already serving on {}".format(address))
+        # left behind by a server that didn't shut down cleanly
+        os.unlink(address)
+    path(address).dirname().makedirs_p()
+    server = ComposeServer(address)
+    log.info("Serving juju-compose on %s", address)
+    # clean up the socket when terminated too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
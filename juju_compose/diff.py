@@ -0,0 +1,241 @@
+"""Line diff backends for utils.delta_python.
+
+Every backend turns two texts into a list of (op, text) segments using
+the diff_match_patch DIFF_* ops, each segment holding whole lines. A
+backend gives up refining the diff once its timeout (seconds, 0 for
+none) has passed, reporting what is left as a plain delete and insert
+like diff_match_patch does with Diff_Timeout.
+
+    dmp       the vendored diff_match_patch in line mode
+    difflib   difflib.SequenceMatcher matching blocks
+    patience  patience diff over NumPy arrays of line ids, falling back to
+              difflib where a region has no unique common lines. Requires
+              numpy.
+"""
+import bisect
+import difflib
+import time
+from collections import OrderedDict
+
+import lazy
+
+dmp = lazy.LazyModule("juju_compose.diff_match_patch")
+numpy = lazy.LazyModule("numpy")
+
+# diff_match_patch.DIFF_EQUAL, DIFF_INSERT and DIFF_DELETE
+EQUAL = 0
+INSERT = 1
+DELETE = -1
+
+DIFF_TIMEOUT = 1.0
+
+
+class LineDiff(object):
+    """Base for backends diffing sequences of lines.
+
+    Subclasses implement matching_blocks returning (i, j, n) triples, in
+    order, of the lines a[i:i+n] == b[j:j+n].
+    """
+    name = None
+    available = True
+
+    def __init__(self, timeout=DIFF_TIMEOUT):
+        self.timeout = timeout
+
+    def deadline(self):
+        if self.timeout and self.timeout > 0:
+            return time.time() + self.timeout
+        return None
+
+    def diff(self, text1, text2):
+        a = text1.splitlines(True)
+        b = text2.splitlines(True)
+        # common prefix and suffix are cheap and common in practice
+        lo = 0
+        top = min(len(a), len(b))
+        while lo < top and a[lo] == b[lo]:
+            lo += 1
+        hi = 0
+        while hi < top - lo and a[-1 - hi] == b[-1 - hi]:
+            hi += 1
+        blocks = [(i + lo, j + lo, n) for i, j, n in self.matching_blocks(
+            a[lo:len(a) - hi], b[lo:len(b) - hi], self.deadline())]
+        blocks = [(0, 0, lo)] + blocks + [(len(a) - hi, len(b) - hi, hi)]
+        diffs = []
+        i = j = 0
+        for bi, bj, n in blocks:
+            if bi > i:
+                diffs.append((DELETE, "".join(a[i:bi])))
+            if bj > j:
+                diffs.append((INSERT, "".join(b[j:bj])))
+            if n:
+                diffs.append((EQUAL, "".join(a[bi:bi + n])))
+            i, j = bi + n, bj + n
+        return _merge(diffs)
+
+    def matching_blocks(self, a, b, deadline):
+        raise NotImplementedError
+
+
+def _merge(diffs):
+    """Join adjacent segments with the same op"""
+    merged = []
+    for op, text in diffs:
+        if merged and merged[-1][0] == op:
+            merged[-1] = (op, merged[-1][1] + text)
+        else:
+            merged.append((op, text))
+    return merged
+
+
+class DMPDiff(LineDiff):
+    name = "dmp"
+
+    def diff(self, text1, text2):
+        differ = dmp.diff_match_patch()
+        differ.Diff_Timeout = self.timeout or 0
+        chars1, chars2, lines = differ.diff_linesToChars(text1, text2)
+        diffs = differ.diff_main(chars1, chars2, False)
+        differ.diff_charsToLines(diffs, lines)
+        return diffs
+
+
+class DifflibDiff(LineDiff):
+    name = "difflib"
+
+    def matching_blocks(self, a, b, deadline):
+        # SequenceMatcher.get_matching_blocks with a deadline on refining
+        matcher = difflib.SequenceMatcher(None, a, b)
+        queue = [(0, len(a), 0, len(b))]
+        blocks = []
+        while queue:
+            if deadline is not None and time.time() > deadline:
+                break
+            alo, ahi, blo, bhi = queue.pop()
+            i, j, k = matcher.find_longest_match(alo, ahi, blo, bhi)
+            if k:
+                blocks.append((i, j, k))
+                if alo < i and blo < j:
+                    queue.append((alo, i, blo, j))
+                if i + k < ahi and j + k < bhi:
+                    queue.append((i + k, ahi, j + k, bhi))
+        blocks.sort()
+        return blocks
+
+
+class PatienceDiff(LineDiff):
+    name = "patience"
+    available = lazy.importable("numpy")
+
+    def matching_blocks(self, a, b, deadline):
+        ids = {}
+        a = numpy.array([ids.setdefault(l, len(ids)) for l in a], dtype=int)
+        b = numpy.array([ids.setdefault(l, len(ids)) for l in b], dtype=int)
+        fallback = DifflibDiff()
+        blocks = []
+        stack = [(0, len(a), 0, len(b))]
+        while stack:
+            alo, ahi, blo, bhi = stack.pop()
+            if alo >= ahi or blo >= bhi:
+                continue
+            if deadline is not None and time.time() > deadline:
+                continue
+            # equal head and tail of the region
+            ra, rb = a[alo:ahi], b[blo:bhi]
+            top = min(len(ra), len(rb))
+            same = ra[:top] != rb[:top]
+            head = int(same.argmax()) if same.any() else top
+            same = ra[::-1][:top - head] != rb[::-1][:top - head]
+            tail = int(same.argmax()) if same.any() else top - head
+            if head:
+                blocks.append((alo, blo, head))
+            if tail:
+                blocks.append((ahi - tail, bhi - tail, tail))
+            alo, blo, ahi, bhi = alo + head, blo + head, ahi - tail, bhi - tail
+            if alo >= ahi or blo >= bhi:
+                continue
+            anchors = self._anchors(a[alo:ahi], b[blo:bhi])
+            if not anchors:
+                blocks.extend((alo + i, blo + j, n) for i, j, n in
+                              fallback.matching_blocks(
+                                  a[alo:ahi].tolist(), b[blo:bhi].tolist(),
+                                  deadline))
+                continue
+            # recurse between the anchors
+            pi, pj = alo, blo
+            for i, j in anchors:
+                blocks.append((alo + i, blo + j, 1))
+                stack.append((pi, alo + i, pj, blo + j))
+                pi, pj = alo + i + 1, blo + j + 1
+            stack.append((pi, ahi, pj, bhi))
+        blocks.sort()
+        return _coalesce(blocks)
+
+    @staticmethod
+    def _anchors(ra, rb):
+        """Return the longest increasing run of (i, j) positions of lines
+        appearing exactly once in both ra and rb"""
+        ua, ca = numpy.unique(ra, return_counts=True)
+        ub, cb = numpy.unique(rb, return_counts=True)
+        common = numpy.intersect1d(ua[ca == 1], ub[cb == 1],
+                                   assume_unique=True)
+        if not len(common):
+            return []
+        ia = numpy.nonzero(numpy.in1d(ra, common))[0]
+        ib = numpy.nonzero(numpy.in1d(rb, common))[0]
+        # position in rb of each unique line, in the order of ra
+        order = numpy.argsort(rb[ib])
+        jb = ib[order][numpy.searchsorted(rb[ib][order], ra[ia])]
+        # patience sort for the longest increasing subsequence of jb
+        tails, tail_idx, prev = [], [], [None] * len(jb)
+        for n, j in enumerate(jb):
+            k = bisect.bisect_left(tails, j)
+            if k:
+                prev[n] = tail_idx[k - 1]
+            if k == len(tails):
+                tails.append(j)
+                tail_idx.append(n)
+            else:
+                tails[k] = j
+                tail_idx[k] = n
+        run = []
+        n = tail_idx[-1]
+        while n is not None:
+            run.append((int(ia[n]), int(jb[n])))
+            n = prev[n]
+        run.reverse()
+        return run
+
+
+def _coalesce(blocks):
+    """Join adjacent matching blocks"""
+    merged = []
+    for i, j, n in blocks:
+        if not n:
+            continue
+        if merged:
+            pi, pj, pn = merged[-1]
+            if pi + pn == i and pj + pn == j:
+                merged[-1] = (pi, pj, pn + n)
+                continue
+        merged.append((i, j, n))
+    return merged
+
+
+BACKENDS = OrderedDict(
+    (cls.name, cls) for cls in (DMPDiff, DifflibDiff, PatienceDiff))
+
+
+def get_backend(backend=None, timeout=DIFF_TIMEOUT):
+    """Return a backend instance given one, its name or None for the
+    default"""
+    if isinstance(backend, LineDiff):
+        return backend
+    cls = BACKENDS.get(backend or "dmp")
+    if cls is None:
+        raise ValueError("Unknown diff backend {}, expected one of {}".format(
+            backend, ", ".join(BACKENDS)))
+    if not cls.available:
+        raise ValueError("The {} diff backend requires numpy".format(
+            cls.name))
+    return cls(timeout)
@@ -1,8 +1,16 @@
 # coding=utf-8
+import collections
 import json
-from ruamel import yaml
+import os
+import sys
+
+from path import path
 import config
+import lazy
 import utils
+from manifest import Manifest, ManifestReader
+
+yaml = lazy.LazyModule("ruamel.yaml")
 
 theme = {
     0: "normal",
@@ -14,67 +22,196 @@ theme = {
 }
 
 
-def scan_for(col, cur, depth):
-    for e, (rel, d) in col[cur:]:
-        if d and d == depth:
-            return True
-    return False
+def walk_tree(directory, ignorer=None, start=None, max_depth=None):
+    """Depth first walk of start (by default directory) yielding (entry,
+    relpath, depth, prefix, isdir) for each entry in tree order, prefix
+    being the tree guide to render before it.
 
+    Each directory is listed and sorted as the walk reaches it, so memory
+    use follows the depth of the walk rather than the size of the tree.
+    Entries rejected by ignorer are skipped and directories at max_depth
+    aren't expanded.
+    """
+    directory = path(directory)
 
-def get_prefix(walk, cur, depth, next_depth):
-    guide = []
-    for i in range(depth):
-        # scan forward in walk from i seeing if a subsequent
-        # entry happens at each depth
-        if scan_for(walk, cur, i):
-            guide.append(" │  ")
-        else:
-            guide.append("    ")
-    if depth == next_depth:
-        prefix = " ├─── "
-    else:
-        prefix = " └─── "
-    return "{}{}".format("".join(guide), prefix)
+    def children(d):
+        entries = []
+        for name in sorted(os.listdir(d)):
+            entry = d / name
+            rel = entry.relpath(directory)
+            isdir = entry.isdir()
+            if ignorer and (not ignorer(rel) or
+                            (isdir and not ignorer(rel + "/"))):
+                continue
+            entries.append((entry, rel, isdir))
+        return entries
+
+    stack = [[children(path(start or directory)), 0, ""]]
+    while stack:
+        frame = stack[-1]
+        entries, i, guide = frame
+        if i == len(entries):
+            stack.pop()
+            continue
+        frame[1] += 1
+        entry, rel, isdir = entries[i]
+        last = i == len(entries) - 1
+        depth = len(stack) - 1
+        yield (entry, rel, depth, guide + (" └─── " if last else " ├─── "),
+               isdir)
+        if isdir and (max_depth is None or depth + 1 < max_depth):
+            stack.append([children(entry), 0,
+                          guide + ("    " if last else " │  ")])
+
+
+def file_record(manifest, entry, rel, status=None):
+    """Describe a file of the charm for machine readable output, its size
+    is None when it can't be read, a dangling symlink say"""
+    owner = manifest.get(rel)
+    try:
+        size = entry.size
+    except OSError:
+        size = None
+    return collections.OrderedDict([
+        ("path", rel),
+        ("layer", owner.layer if owner else None),
+        ("kind", owner.kind if owner else None),
+        ("size", size),
+        ("added", status == "added"),
+        ("changed", status == "changed"),
+    ])
+
+
+class LayerStats(object):
+    """Running per layer totals of file records, see layer_stats"""
+    def __init__(self, layers=()):
+        self.stats = collections.OrderedDict(
+            (layer, dict(files=0, bytes=0, dynamic=0, static=0))
+            for layer in layers)
+        self.total = 0
+
+    def add(self, record):
+        s = self.stats.setdefault(record["layer"], dict(
+            files=0, bytes=0, dynamic=0, static=0))
+        s["files"] += 1
+        if record["size"] is None:
+            return
+        s["bytes"] += record["size"]
+        if record["kind"] in ("dynamic", "static"):
+            s[record["kind"]] += record["size"]
+        self.total += record["size"]
+
+    def result(self):
+        for s in self.stats.values():
+            s["share"] = (float(s["bytes"]) / self.total
+                          if self.total else 0.0)
+        return self.stats
+
+
+def layer_stats(records, layers=()):
+    """Aggregate file records per owning layer.
+
+    Returns an OrderedDict of layer name to its file count, bytes, bytes
+    of dynamic and static files and share of the total size, in the order
+    of layers followed by any other owner (None for untracked files).
+    """
+    stats = LayerStats(layers)
+    for record in records:
+        stats.add(record)
+    return stats.result()
+
+
+def inspect(charm, verify=True, digests=None, format="text", stats=False,
+            fp=None, subdir=None, depth=None):
+    """Render the files of charm coloured by the layer that produced them.
 
+    Only the subtree at subdir, down to depth levels, is walked and output
+    is written as the walk goes.
 
-def inspect(charm):
-    tw = utils.TermWriter()
+    With verify, files added or changed since the charm was composed are
+    marked, re-hashing only the files whose stat no longer matches the
+    manifest through digests (by default the persistent digest cache of
+    the charm).
+
+    The json format streams one record per file (see file_record) as JSON
+    lines followed by a {"layers": layer_stats} line. stats adds the same
+    aggregates to the text output.
+
+    The manifest is read from disk only for what is shown: the records
+    under subdir, or those of the walked files when limited by depth.
+    """
+    if fp is None:
+        fp = sys.stdout
+    tw = utils.TermWriter(fp)
     manp = charm / ".composer.manifest"
     comp = charm / "composer.yaml"
     if not manp.exists() or not comp.exists():
         return
-    manifest = json.loads(manp.text())
+    start = charm / subdir if subdir else charm
+    if not start.isdir():
+        raise OSError("No such directory {}".format(start))
+    reader = ManifestReader(manp)
+    lookup = None
+    prefix = start.relpath(charm)
+    if prefix != ".":
+        manifest = Manifest(reader.layers,
+                            dict(reader.prefixed(prefix + "/")))
+    elif depth is not None:
+        # filled in as the walk reaches each file
+        manifest = Manifest(reader.layers)
+        lookup = reader.lookup
+    else:
+        manifest = Manifest(reader.layers, dict(reader))
     composer = yaml.load(comp.open())
-    a, c, d = utils.delta_signatures(manp)
+    if verify and digests is None:
+        digests = utils.PersistentDigestRegistry.for_directory(charm)
 
     # ordered list of layers used for legend
-    layers = list(manifest['layers'])
-
-    def get_depth(e):
-        rel = e.relpath(charm)
-        depth = len(rel.splitall()) - 2
-        return rel, depth
-
-    def get_suffix(rel):
-        suffix = ""
-        if rel in a:
-            suffix = "+"
-        elif rel in c:
-            suffix = "*"
-        return suffix
-
-    def get_color(rel):
+    layers = list(manifest.layers)
+
+    def get_status(rel, isdir):
+        if not verify or isdir:
+            return None
+        return manifest.status(charm, rel, digests)
+
+    def get_color(rel, isdir):
         # name of layer this belongs to
         color = tw.term.normal
-        if rel in manifest['signatures']:
-            layer = manifest['signatures'][rel][0]
+        if rel in manifest:
+            layer = manifest[rel].layer
             layer_key = layers.index(layer)
             color = getattr(tw, theme.get(layer_key, "normal"))
         else:
-            if entry.isdir():
+            if isdir:
                 color = tw.blue
         return color
 
+    def files(walk):
+        for entry, rel, _, prefix, isdir in walk:
+            if lookup and not isdir:
+                owner = lookup(rel)
+                if owner is not None:
+                    manifest.signatures[rel] = owner
+            yield entry, rel, prefix, isdir
+
+    ignorer = utils.ignore_matcher(config.DEFAULT_IGNORES)
+    walk = files(walk_tree(charm, ignorer, start, depth))
+    totals = LayerStats(layers)
+
+    if format == "json":
+        for entry, rel, _, isdir in walk:
+            if isdir:
+                continue
+            record = file_record(manifest, entry, rel,
+                                 get_status(rel, isdir))
+            totals.add(record)
+            fp.write(json.dumps(record) + "\n")
+        fp.write(json.dumps(dict(layers=totals.result())))
+        fp.write("\n")
+        if hasattr(digests, "save"):
+            digests.save()
+        return
+
     tw.write("Inspect %s\n" % composer["is"])
     for layer in layers:
         tw.write("# {color}{layer}{t.normal}\n",
@@ -82,20 +219,32 @@ def inspect(charm):
                      layers.index(layer), "normal")),
                  layer=layer)
     tw.write("\n")
-    tw.write("{t.blue}{target}{t.normal}\n", target=charm)
-
-    ignorer = utils.ignore_matcher(config.DEFAULT_IGNORES)
-    walk = sorted(utils.walk(charm, get_depth),
-                    key=lambda x: x[1][0])
-    for i in range(len(walk) - 1):
-        entry, (rel, depth) = walk[i]
-        nEnt, (nrel, ndepth) = walk[i + 1]
-        if not ignorer(rel):
-            continue
+    tw.write("{t.blue}{target}{t.normal}\n", target=start)
 
+    for entry, rel, prefix, isdir in walk:
+        status = get_status(rel, isdir)
+        if stats and not isdir:
+            totals.add(file_record(manifest, entry, rel, status))
         tw.write("{prefix}{layerColor}{entry} "
-                    "{t.bold}{suffix}{t.normal}\n",
-                    prefix=get_prefix(walk, i, depth, ndepth),
-                    layerColor=get_color(rel),
-                    suffix=get_suffix(rel),
-                    entry=rel.name)
+                 "{t.bold}{suffix}{t.normal}\n",
+                 prefix=prefix,
+                 layerColor=get_color(rel, isdir),
+                 suffix={"added": "+", "changed": "*"}.get(status, ""),
+                 entry=rel.name)
+    if hasattr(digests, "save"):
+        digests.save()
+    if stats:
+        write_stats(tw, totals.result(), layers)
+
+
+def write_stats(tw, stats, layers):
+    tw.write("\n{:<30} {:>7} {:>12} {:>12} {:>12} {:>7}\n",
+             "layer", "files", "bytes", "dynamic", "static", "share")
+    for layer, s in stats.items():
+        if layer in layers:
+            color = getattr(tw, theme.get(layers.index(layer), "normal"))
+        else:
+            color = tw.term.normal
+        tw.write("{color}{layer:<30}{t.normal} {files:>7} {bytes:>12} "
+                 "{dynamic:>12} {static:>12} {share:>7.1%}\n",
+                 color=color, layer=layer or "(untracked)", **s)
@@ -0,0 +1,53 @@
+"""Modules imported on first use.
+
+Heavy dependencies are bound at module level as
+
+    requests = lazy.LazyModule("requests")
+
+and only imported once one of their attributes is looked up, so short
+runs like juju-inspect or --help don't pay for the fetchers, YAML and
+diff engines they never touch.
+"""
+import importlib
+import pkgutil
+import threading
+import types
+
+_lock = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """Stand in for the module name, importing it on first attribute
+    access. Lookups and assignments are forwarded to the real module"""
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__["_module"] = None
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] else "not loaded"
+        return "<LazyModule {} ({})>".format(self.__name__, state)
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            with _lock:
+                module = self.__dict__["_module"]
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+def importable(name):
+    """Whether the top level module name can be imported, without
+    importing it"""
+    try:
+        return pkgutil.find_loader(name) is not None
+    except ImportError:
+        return False
@@ -0,0 +1,253 @@
+"""Lint interface modules that would be overridden in the output charm.
+
+Every tactic may name (source, target) pairs of python files through
+Tactic.lint_targets. Pairs whose files differ are compared in a process
+pool, the comparison being CPU bound, and the diagnostics are written in
+a stable order once all are in. Two modes are available:
+
+    diff  diff the files with utils.delta_python and report hunks near
+          REACTIVE_PATTERNS
+    ast   parse both files and compare their reactive handlers, see
+          handlers
+"""
+import ast
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+
+from path import path
+import utils
+
+log = logging.getLogger("composer")
+
+MODES = ("diff", "ast")
+DECORATORS = ("when", "when_not", "when_any", "when_all", "when_none",
+              "when_file_changed", "hook", "only_once", "not_unless")
+STATE_CALLS = ("set_state", "remove_state")
+
+# bump when the lint output for the same files would change
+VERSION = 1
+
+_handlers = {}
+
+
+class HandlerVisitor(ast.NodeVisitor):
+    def __init__(self):
+        self.scope = []
+        self.signatures = set()
+
+    def _scoped(self, node):
+        self.scope.append(node.name)
+        self.generic_visit(node)
+        self.scope.pop()
+
+    visit_ClassDef = _scoped
+
+    def visit_FunctionDef(self, node):
+        name = ".".join(self.scope + [node.name])
+        for decorator in node.decorator_list:
+            call = _call(decorator, DECORATORS)
+            if call:
+                self.signatures.add(("handler", name) + call)
+        self._scoped(node)
+
+    def visit_Call(self, node):
+        call = _call(node, STATE_CALLS)
+        if call:
+            self.signatures.add(("state", ".".join(self.scope)) + call)
+        self.generic_visit(node)
+
+
+def _name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+
+def _value(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return ast.dump(node)
+
+
+def _call(node, names):
+    """Return (name, args) for a call to one of names, a bare decorator
+    counts as a call without arguments"""
+    if isinstance(node, ast.Call):
+        name = _name(node.func)
+        if name in names:
+            return name, tuple(_value(a) for a in node.args)
+    elif _name(node) in names:
+        return _name(node), ()
+    return None
+
+
+def handlers(filename):
+    """Return the reactive signatures of the python module filename as a
+    frozenset of tuples:
+
+        ("handler", function, decorator, args)
+        ("state", function, set_state|remove_state, args)
+
+    Results are memoized by file digest. Raises SyntaxError if the file
+    can't be parsed.
+    """
+    digest = utils.sign(filename)
+    if digest not in _handlers:
+        visitor = HandlerVisitor()
+        visitor.visit(ast.parse(path(filename).bytes(), filename))
+        _handlers[digest] = frozenset(visitor.signatures)
+    return _handlers[digest]
+
+
+def delta(args):
+    """Compare the files of args, (source, target, diff backend name,
+    mode). Runs in the pool so only takes and returns plain data: a list
+    of delta_python hunks in diff mode or of (op, signature) pairs in ast
+    mode, op being -1 for removed and 1 for added."""
+    src, target, backend, mode = args
+    src, target = path(src), path(target)
+    if not target.exists() or utils.sign(src) == utils.sign(target):
+        return mode, []
+    if mode == "ast":
+        try:
+            old, new = handlers(src), handlers(target)
+        except SyntaxError:
+            mode = "diff"
+        else:
+            return mode, ([(-1, sig) for sig in sorted(old - new)] +
+                          [(1, sig) for sig in sorted(new - old)])
+    return mode, [[lineno, last and tuple(last), tuple(current)]
+                  for lineno, last, current in utils.delta_python(
+                      src, target, backend=backend)]
+
+
+def write_handler_delta(changes, orig_name, dest_name, term=None):
+    """Render the ast mode changes, returning True if there were none"""
+    if not changes:
+        return True
+    if term is None:
+        term = utils.TermWriter()
+    term.write("{t.bold}{orig}{t.normal} --> {t.bold}{dest}{t.normal}:\n",
+               orig=orig_name, dest=dest_name)
+    for op, sig in changes:
+        _, function, call, args = sig
+        term.write("{color}{op} {function}: {call}({args}){t.normal}\n",
+                   color=term.red if op < 0 else term.green,
+                   op="-" if op < 0 else "+",
+                   function=function or "<module>", call=call,
+                   args=", ".join(repr(a) for a in args))
+    return False
+
+
+def _from_json(value):
+    if isinstance(value, list):
+        return tuple(_from_json(v) for v in value)
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class LintCache(object):
+    """Lint results on disk keyed by the digests of both files and
+    everything else that decides the result: mode, diff backend and the
+    patterns or handler names looked for.
+
+    Results not written for max_age seconds are dropped as new ones are
+    put, at most every PRUNE_INTERVAL seconds.
+    """
+    PRUNE_INTERVAL = 600
+
+    def __init__(self, root, max_age=30 * 24 * 3600):
+        self.root = path(root)
+        self.max_age = max_age
+
+    def key(self, src_sha, target_sha, backend, mode):
+        h = hashlib.sha256()
+        h.update("{}\0{}\0{}\0{}\0{}\n".format(
+            VERSION, src_sha, target_sha, backend, mode))
+        if mode == "ast":
+            h.update(repr(DECORATORS + STATE_CALLS))
+        else:
+            h.update(repr([p.pattern for p in utils.REACTIVE_PATTERNS]))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self.root / key[:2] / "{}.json".format(key)
+
+    def get(self, key):
+        try:
+            kind, changes = json.loads(self._path(key).text())
+        except (IOError, OSError, ValueError):
+            return None
+        return kind.encode("utf-8"), list(_from_json(changes))
+
+    def put(self, key, result):
+        target = self._path(key)
+        target.dirname().makedirs_p()
+        fd, tmp = tempfile.mkstemp(dir=target.dirname())
+        with os.fdopen(fd, 'wb') as fp:
+            json.dump(result, fp)
+        os.rename(tmp, target)
+        utils.expire(self.root, self.max_age, self.PRUNE_INTERVAL)
+
+
+def lint_files(pairs, jobs=None, term=None, backend=None, mode="diff",
+               cache=None, digests=None):
+    """Lint (source, target, from_name, to_name) pairs, using up to jobs
+    processes, the named diff backend and mode. Duplicate pairs are
+    linted once and pairs with a result in cache (a LintCache) aren't
+    compared again, digests optionally being a utils.DigestRegistry.
+    Returns True if no pair has reactive changes."""
+    unique = {}
+    for pair in pairs:
+        unique.setdefault((str(pair[0]), str(pair[1])), pair)
+    pairs = [unique[k] for k in sorted(unique)]
+    if not pairs:
+        return True
+    if digests is None:
+        digests = utils.sign
+    results = [None] * len(pairs)
+    keys = {}
+    for i, (src, target, _, _) in enumerate(pairs):
+        src_sha, target_sha = digests(path(src)), digests(path(target))
+        if target_sha is None or src_sha == target_sha:
+            results[i] = (mode, [])
+        elif cache is not None:
+            keys[i] = cache.key(src_sha, target_sha, backend, mode)
+            results[i] = cache.get(keys[i])
+    todo = [i for i, result in enumerate(results) if result is None]
+    args = [(str(pairs[i][0]), str(pairs[i][1]), backend, mode)
+            for i in todo]
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(todo))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            computed = pool.map(delta, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        computed = map(delta, args)
+    for i, result in zip(todo, computed):
+        results[i] = result
+        if i in keys:
+            cache.put(keys[i], result)
+    ok = True
+    for (src, target, from_name, to_name), (kind, changes) in zip(
+            pairs, results):
+        if kind == "ast":
+            ok &= write_handler_delta(changes, from_name, to_name, term)
+        else:
+            ok &= utils.write_delta(changes, from_name, to_name, term=term)
+    if not ok:
+        log.warn("Lint found changes to reactive handlers")
+    return ok
@@ -0,0 +1,425 @@
+import collections
+import json
+import os
+import posixpath
+import stat
+
+from path import path
+import utils
+
+FILENAME = ".composer.manifest"
+VERSION = 4
+
+Entry = collections.namedtuple("Entry",
+                               "layer kind sha256 size mtime_ns")
+
+
+def _stat_leaf(size, mtime_ns):
+    return "{}:{}".format(size, mtime_ns)
+
+
+def _text(s):
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s
+
+
+class ManifestWriter(object):
+    """Stream a manifest to disk.
+
+    The format is JSON lines: a header object with the version and the
+    layer table, one [relpath, layer index, kind, sha256, size, mtime_ns]
+    record per file in sorted relpath order. The file is written to a
+    temporary name and renamed into place on close.
+    """
+    def __init__(self, filename, layers):
+        self.filename = path(filename)
+        self.layers = list(layers)
+        self._tmp = self.filename + ".tmp"
+        self._fp = open(self._tmp, 'wb')
+        self._last = None
+        self._write(dict(version=VERSION, layers=self.layers))
+
+    def _write(self, obj):
+        self._fp.write(json.dumps(obj, separators=(',', ':')))
+        self._fp.write("\n")
+
+    def add(self, relpath, entry):
+        relpath = _text(relpath)
+        if self._last is not None and relpath <= self._last:
+            raise ValueError("Manifest entries must be added in order, "
+                             "got {} after {}".format(relpath, self._last))
+        self._last = relpath
+        if entry.layer not in self.layers:
+            raise ValueError("Layer {} missing from manifest layers".format(
+                entry.layer))
+        self._write([relpath, self.layers.index(entry.layer), entry.kind,
+                     entry.sha256, entry.size, entry.mtime_ns])
+
+    def close(self):
+        self._fp.close()
+        os.rename(self._tmp, self.filename)
+
+    def abort(self):
+        self._fp.close()
+        path(self._tmp).remove_p()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ManifestReader(object):
+    """Lazy access to a manifest on disk.
+
+    Iterating yields (relpath, Entry) in sorted order without loading the
+    whole file and `lookup` binary searches the records for a single
+    path. Older whole-document JSON manifests are loaded into memory when
+    opened.
+    """
+    def __init__(self, filename):
+        self.filename = path(filename)
+        self._legacy = None
+        with open(self.filename, 'rb') as fp:
+            first = fp.readline()
+            try:
+                header = json.loads(first)
+            except ValueError:
+                header = None
+            if header is None or 'signatures' in header:
+                fp.seek(0)
+                self._load_legacy(json.load(fp))
+                return
+            self.version = header.get('version')
+            if self.version not in (3, VERSION):
+                raise ValueError(
+                    "Unsupported manifest version {} in {}".format(
+                        self.version, filename))
+            self.layers = header['layers']
+            self._start = fp.tell()
+            fp.seek(0, os.SEEK_END)
+            self._end = fp.tell()
+            if self.version == 3:
+                # skip the trailer holding a tree of directory digests
+                self._end = self._last_line_offset(fp)
+
+    def _load_legacy(self, data):
+        self.layers = data.get('layers', [])
+        self.version = data.get('version', 1)
+        sigs = {}
+        if self.version == 1:
+            for rel, (layer, kind, sha) in data['signatures'].items():
+                sigs[rel] = Entry(layer, kind, sha, None, None)
+        elif self.version == 2:
+            for rel, (idx, kind, sha, size, mtime_ns) in \
+                    data['signatures'].items():
+                sigs[rel] = Entry(self.layers[idx], kind, sha, size,
+                                  mtime_ns)
+        else:
+            raise ValueError("Unsupported manifest version {} in {}".format(
+                self.version, self.filename))
+        self._legacy = sigs
+
+    @staticmethod
+    def _last_line_offset(fp):
+        """Offset of the start of the last line of fp, fp must be at EOF"""
+        pos = fp.tell() - 1  # skip the final newline
+        while pos > 0:
+            start = max(0, pos - 4096)
+            fp.seek(start)
+            i = fp.read(pos - start).rfind("\n")
+            if i != -1:
+                return start + i + 1
+            pos = start
+        return 0
+
+    def _record(self, line):
+        rel, idx, kind, sha, size, mtime_ns = json.loads(line)
+        return rel, Entry(self.layers[idx], kind, sha, size, mtime_ns)
+
+    def __iter__(self):
+        if self._legacy is not None:
+            for item in sorted(self._legacy.items()):
+                yield item
+            return
+        with open(self.filename, 'rb') as fp:
+            fp.seek(self._start)
+            while fp.tell() < self._end:
+                yield self._record(fp.readline())
+
+    def _bisect(self, fp, relpath):
+        """Offset of the first record of fp at or after relpath"""
+        lo, hi = self._start, self._end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid > lo:
+                # align to the first record starting at or after mid
+                fp.seek(mid - 1)
+                fp.readline()
+            else:
+                fp.seek(mid)
+            pos = fp.tell()
+            if pos >= hi:
+                hi = mid
+                continue
+            line = fp.readline()
+            if self._record(line)[0] < relpath:
+                lo = pos + len(line)
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, relpath):
+        """Return the Entry for relpath or None"""
+        if self._legacy is not None:
+            return self._legacy.get(relpath)
+        relpath = _text(relpath)
+        with open(self.filename, 'rb') as fp:
+            fp.seek(self._bisect(fp, relpath))
+            if fp.tell() < self._end:
+                rel, entry = self._record(fp.readline())
+                if rel == relpath:
+                    return entry
+        return None
+
+    def prefixed(self, prefix):
+        """Yield the (relpath, Entry) records whose relpath starts with
+        prefix, in sorted order"""
+        if self._legacy is not None:
+            for rel, entry in sorted(self._legacy.items()):
+                if rel.startswith(prefix):
+                    yield rel, entry
+            return
+        prefix = _text(prefix)
+        with open(self.filename, 'rb') as fp:
+            fp.seek(self._bisect(fp, prefix))
+            while fp.tell() < self._end:
+                rel, entry = self._record(fp.readline())
+                if not rel.startswith(prefix):
+                    return
+                yield rel, entry
+
+
+def _entries(directory, signatures):
+    directory = path(directory)
+    sigs = {}
+    for rel, (layer, kind, sha) in signatures.items():
+        size = mtime_ns = None
+        try:
+            st = os.stat(directory / rel)
+        except OSError:
+            pass
+        else:
+            size, mtime_ns, _ = utils.stat_fingerprint(st)
+        sigs[rel] = Entry(layer, kind, sha, size, mtime_ns)
+    return sigs
+
+
+class Manifest(object):
+    """The record of which layer produced each file of a composed charm.
+
+    Each signature is kept as an Entry of (layer, kind, sha256, size,
+    mtime_ns). The stat information lets validation trust the recorded
+    digest of any file that hasn't been touched since it was signed.
+    Manifests written before size and mtime were recorded are still read,
+    they just don't benefit from the stat fast path.
+
+    See ManifestWriter for the on disk format, use ManifestReader directly
+    when only a few entries are needed.
+    """
+    def __init__(self, layers=None, signatures=None):
+        self.layers = list(layers or [])
+        self.signatures = signatures or {}
+
+    def __contains__(self, relpath):
+        return relpath in self.signatures
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def get(self, relpath, default=None):
+        return self.signatures.get(relpath, default)
+
+    def __getitem__(self, relpath):
+        return self.signatures[relpath]
+
+    def layer_index(self, layer):
+        try:
+            return self.layers.index(layer)
+        except ValueError:
+            self.layers.append(layer)
+            return len(self.layers) - 1
+
+    @classmethod
+    def from_signatures(cls, directory, signatures, layers):
+        """Build a manifest from the {relpath: (layer, kind, sha256)} data
+        produced by the tactics of a build, recording the current stat of
+        each file in directory."""
+        return cls(layers, _entries(directory, signatures))
+
+    def update(self, directory, signatures, removed=()):
+        """Re-sign just the relpaths of signatures, as from_signatures
+        does, and drop the removed relpaths"""
+        self.signatures.update(_entries(directory, signatures))
+        for rel in removed:
+            self.signatures.pop(rel, None)
+
+    @classmethod
+    def load(cls, filename):
+        reader = ManifestReader(filename)
+        sigs = dict(reader)
+        return cls(reader.layers, sigs)
+
+    def write(self, filename):
+        for e in self.signatures.values():
+            self.layer_index(e.layer)
+        with ManifestWriter(filename, self.layers) as writer:
+            for rel in sorted(self.signatures, key=_text):
+                writer.add(rel, self.signatures[rel])
+
+    def _grouped(self):
+        """The recorded entries of each directory and its subdirectories,
+        ({dirpath: {name: Entry}}, {dirpath: set of names})"""
+        groups = {}
+        for rel, e in self.signatures.items():
+            if e.layer != "composer":
+                d, name = posixpath.split(rel)
+                groups.setdefault(d, {})[name] = e
+        kids = {}
+        for d in groups:
+            while d:
+                d, name = posixpath.split(d)
+                kids.setdefault(d, set()).add(name)
+        return groups, kids
+
+    def delta(self, directory, ignorer=None, digests=None, quick=False,
+              jobs=None):
+        """Compare directory with the manifest returning the sets of
+        (added, changed, deleted) relpaths.
+
+        Ignored directories are pruned from the walk and files owned by
+        `composer` are never examined. Every other file is stat()ed and
+        compared with the recorded entries of its directory, only files
+        whose size or mtime changed are re-hashed, using jobs threads.
+
+        With quick=True this returns at the first walked directory holding
+        an unexpected change, so at most one entry is reported.
+        """
+        directory = path(directory)
+        groups, kids = self._grouped()
+        seen = set()
+        add, change = set(), set()
+        suspects = []
+        for root, dirs, files in os.walk(directory):
+            reldir = path(root).relpath(directory)
+            if reldir == ".":
+                reldir = ""
+            if ignorer:
+                dirs[:] = [d for d in dirs
+                           if ignorer(posixpath.join(reldir, d) + "/")]
+            for d in dirs:
+                seen.add(posixpath.join(reldir, d))
+            leaves = {}
+            for name in files:
+                rel = posixpath.join(reldir, name)
+                seen.add(rel)
+                e = self.signatures.get(rel)
+                if e is not None and e.layer == "composer":
+                    continue
+                if ignorer and not ignorer(rel):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                size, mtime_ns, _ = utils.stat_fingerprint(st)
+                leaves[name] = _stat_leaf(size, mtime_ns)
+            if quick:
+                first = self._first_change(directory, reldir, leaves, dirs,
+                                           groups, kids, seen, digests, jobs)
+                if first:
+                    return first
+                continue
+            entries = groups.get(reldir, {})
+            for name, leaf in leaves.items():
+                rel = path(posixpath.join(reldir, name))
+                e = entries.get(name)
+                if e is None:
+                    add.add(rel)
+                elif _stat_leaf(e.size, e.mtime_ns) != leaf:
+                    suspects.append(rel)
+        if quick:
+            for rel, e in sorted(self.signatures.items()):
+                if e.layer == "composer" and rel not in seen:
+                    return set(), set(), set([path(rel)])
+            return set(), set(), set()
+        # recorded files in removed or ignored directories weren't seen
+        delete = set(path(rel) for rel in self.signatures if rel not in seen)
+
+        for fn, digest in utils.sign_all([directory / rel
+                                          for rel in suspects],
+                                         digests, jobs):
+            rel = fn.relpath(directory)
+            if self.signatures[rel].sha256 != digest:
+                change.add(rel)
+        return add, change, delete
+
+    def _first_change(self, directory, d, leaves, dirs, groups, kids, seen,
+                      digests, jobs):
+        """The first unexpected change in the walked directory d as an
+        (added, changed, deleted) triple of sets, or None"""
+        entries = groups.get(d, {})
+        gone = kids.get(d, set()).difference(dirs)
+        if not gone and leaves == dict(
+                (name, _stat_leaf(e.size, e.mtime_ns))
+                for name, e in entries.items()):
+            return None
+        suspects = []
+        for name in sorted(set(leaves) | set(entries)):
+            rel = path(posixpath.join(d, name))
+            if name not in leaves:
+                if rel not in seen:
+                    return set(), set(), set([rel])
+            elif name not in entries:
+                return set([rel]), set(), set()
+            elif (_stat_leaf(entries[name].size, entries[name].mtime_ns) !=
+                    leaves[name]):
+                suspects.append(directory / rel)
+        for name in sorted(gone):
+            # a recorded subdirectory that was removed or is ignored
+            prefix = posixpath.join(d, name) + "/"
+            return set(), set(), set([path(min(
+                rel for rel, e in self.signatures.items()
+                if e.layer != "composer" and rel.startswith(prefix)))])
+        for fn, digest in utils.sign_all(suspects, digests, jobs):
+            rel = fn.relpath(directory)
+            if self.signatures[rel].sha256 != digest:
+                return set(), set([rel]), set()
+        return None
+
+    def status(self, directory, relpath, digests=None):
+        """Compare a single file with the manifest, returning "added",
+        "changed" or None. The file is only hashed when its stat differs
+        from the recorded one."""
+        e = self.signatures.get(relpath)
+        if e is None:
+            return "added"
+        if e.layer == "composer":
+            return None
+        fn = path(directory) / relpath
+        try:
+            size, mtime_ns, _ = utils.stat_fingerprint(fn.stat())
+        except OSError:
+            return None
+        if (size, mtime_ns) == (e.size, e.mtime_ns):
+            return None
+        if (digests or utils.sign)(fn) != e.sha256:
+            return "changed"
+        return None
@@ -0,0 +1,119 @@
+"""Tactics installed as setuptools entry points.
+
+Packages register tactics in the juju_compose.tactics group, the entry
+point name being a glob of the relpaths the tactic handles:
+
+    entry_points={
+        'juju_compose.tactics': [
+            '*.rst = mytactics.docs:RSTTactic',
+        ]
+    }
+
+The entry points found are cached under the user cache for as long as
+the sys.path directories are unchanged, so builds don't import
+pkg_resources, and a tactic's module is only imported once a relpath
+matches its glob.
+"""
+import fnmatch
+import importlib
+import json
+import logging
+import os
+import re
+import sys
+
+from path import path
+import utils
+
+log = logging.getLogger("composer")
+
+GROUP = "juju_compose.tactics"
+
+_tactics = None
+
+
+def _path_fingerprint():
+    fingerprint = []
+    for entry in sys.path:
+        try:
+            mtime = utils.stat_fingerprint(os.stat(entry or "."))[1]
+        except OSError:
+            mtime = None
+        fingerprint.append([entry, mtime])
+    return fingerprint
+
+
+def _scan(group):
+    import pkg_resources
+    found = []
+    for ep in pkg_resources.WorkingSet().iter_entry_points(group):
+        found.append([ep.name, ep.module_name, ".".join(ep.attrs)])
+    return sorted(found)
+
+
+def entry_points(group=GROUP):
+    """Return sorted [name, module, attrs] for the entry points of
+    group"""
+    cached = path(utils.cache_dir("plugins", "{}.json".format(group)))
+    fingerprint = _path_fingerprint()
+    try:
+        data = json.loads(cached.text())
+        if data["path"] == fingerprint:
+            return data["entry_points"]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    found = _scan(group)
+    try:
+        cached.dirname().makedirs_p()
+        tmp = cached + ".tmp"
+        path(tmp).write_text(json.dumps(dict(path=fingerprint,
+                                             entry_points=found)))
+        os.rename(tmp, cached)
+    except (IOError, OSError):
+        pass
+    return found
+
+
+class LazyTactic(object):
+    """Stand in for a Tactic class from an entry point, importing it the
+    first time a relpath matches the entry point's glob"""
+    def __init__(self, pattern, module, attrs):
+        self.pattern = pattern
+        self.module = module
+        self.attrs = attrs
+        self._match = re.compile(fnmatch.translate(pattern)).match
+        self._tactic = None
+
+    def __repr__(self):
+        return "<LazyTactic {} = {}:{}>".format(
+            self.pattern, self.module, self.attrs)
+
+    @property
+    def tactic(self):
+        if self._tactic is None:
+            from tactics import Tactic
+            obj = importlib.import_module(self.module)
+            for attr in self.attrs.split("."):
+                obj = getattr(obj, attr)
+            if not issubclass(obj, Tactic):
+                raise ValueError("Expected to load a tactic for {}".format(
+                    self))
+            log.debug("Loaded tactic %s", self)
+            self._tactic = obj
+        return self._tactic
+
+    def trigger(self, relpath):
+        if not self._match(relpath):
+            return False
+        return self.tactic.trigger(relpath)
+
+    def __call__(self, *args, **kwargs):
+        return self.tactic(*args, **kwargs)
+
+
+def plugin_tactics():
+    """The tactics registered through entry points, in name order"""
+    global _tactics
+    if _tactics is None:
+        _tactics = [LazyTactic(*ep) for ep in entry_points()]
+    return _tactics
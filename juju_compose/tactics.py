@@ -1,10 +1,13 @@
 import logging
 import json
-from ruamel import yaml
-
+import shutil
+import tempfile
 from path import path
+import lazy
 import utils
 
+yaml = lazy.LazyModule("ruamel.yaml")
+
 log = logging.getLogger(__name__)
 
 
@@ -21,6 +24,12 @@ class Tactic(object):
     actions are needed.
     """
     kind = "static"  # used in signatures
+    # utils.ProcessPool subprocesses may be run on while composing, results
+    # are due by sign()
+    pool = None
+    # utils.DigestRegistry shared by the tactics of a build, set before
+    # sign() is called
+    digests = None
 
     def __init__(self, entity, current, target, config):
         self.entity = entity
@@ -32,6 +41,19 @@ class Tactic(object):
     def __call__(self):
         raise NotImplementedError
 
+    def writes_to(self, directory):
+        """Whether __call__ may write in directory, under it or over it"""
+        return _overlaps(self.target_file, directory)
+
+    def pending(self):
+        """The directory work __call__ left running will land in once
+        settle() is called, None if there is none"""
+        return None
+
+    def settle(self):
+        """Wait for work __call__ left running and put its results in
+        place"""
+
     def __str__(self):
         return "{}: {} -> {}".format(
             self.__class__.__name__, self.entity, self.target_file)
@@ -80,20 +102,38 @@ class Tactic(object):
         """Should the rule trigger for a given path object"""
         return False
 
-    def sign(self):
+    def _digester(self, digests=None):
+        """The digest function to sign with: digests, the build's registry
+        or plain utils.sign"""
+        if digests is not None:
+            return digests
+        if self.digests is not None:
+            return self.digests
+        return utils.sign
+
+    def sign(self, digests=None):
         """return sign in the form {relpath: (origin layer, SHA256)}
+
+        digests defaults to the `utils.DigestRegistry` shared by all the
+        tactics of a build, so each output file is hashed only once.
         """
+        digests = self._digester(digests)
         target = self.target_file
         sig = {}
         if target.exists() and target.isfile():
             sig[self.relpath] = (self.current.url,
                                  self.kind,
-                                 utils.sign(self.target_file))
+                                 digests(self.target_file))
         return sig
 
     def lint(self):
         return True
 
+    def lint_targets(self):
+        """Return (source, target, from_name, to_name) pairs of python
+        files the lint phase should diff, see juju_compose.lint"""
+        return []
+
     def read(self):
         return None
 
@@ -145,6 +185,9 @@ class InterfaceCopy(Tactic):
     def target(self):
         return self._target / "hooks/relations" / self.interface.name
 
+    def writes_to(self, directory):
+        return _overlaps(self.target, directory)
+
     def __call__(self):
         # copy the entire tree into the
         # hooks/relations/<interface>
@@ -172,26 +215,26 @@ class InterfaceCopy(Tactic):
     def __str__(self):
         return "Copy Interface {}".format(self.interface.name)
 
-    def sign(self):
+    def sign(self, digests=None):
         """return sign in the form {relpath: (origin layer, SHA256)}
         """
+        digests = self._digester(digests)
         sigs = {}
         for entry, sig in utils.walk(self.target,
-                                     utils.sign, kind="files"):
+                                     digests, kind="files"):
             relpath = entry.relpath(self._target.directory)
             sigs[relpath] = (self.interface.url, "static", sig)
         return sigs
 
-    def lint(self):
-        for entry in self.interface.directory.walkfiles():
-            if entry.splitext()[1] != ".py":
-                continue
-            relpath = entry.relpath(self._target.directory)
-            target = self._target.directory / relpath
-            if not target.exists():
-                continue
-            return utils.delta_python_dump(entry, target,
-                                           from_name=relpath)
+    def lint_targets(self):
+        pairs = []
+        for entry in self.interface.directory.walkfiles("*.py"):
+            relpath = entry.relpath(self.interface.directory)
+            target = self.target / relpath
+            if target.exists():
+                pairs.append((entry, target, relpath,
+                              target.relpath(self._target.directory)))
+        return pairs
 
 
 class InterfaceBind(InterfaceCopy):
@@ -207,6 +250,9 @@ from charmhelpers.core.reactive import main
 main('{}')
 """
 
+    def writes_to(self, directory):
+        return _overlaps(self._target.directory / "hooks", directory)
+
     def __call__(self):
         for hook in ['joined', 'changed', 'broken', 'departed']:
             target = self._target / "hooks" / "{}-relation-{}".format(
@@ -218,9 +264,10 @@ main('{}')
             target.write_text(self.DEFAULT_BINDING.format(self.relation_name))
             target.chmod(0755)
 
-    def sign(self):
+    def sign(self, digests=None):
         """return sign in the form {relpath: (origin layer, SHA256)}
         """
+        digests = self._digester(digests)
         sigs = {}
         for hook in ['joined', 'changed', 'broken', 'departed']:
             target = self._target / "hooks" / "{}-relation-{}".format(
@@ -228,7 +275,7 @@ main('{}')
             rel = target.relpath(self._target.directory)
             sigs[rel] = (self.interface.url,
                          "dynamic",
-                         utils.sign(target))
+                         digests(target))
         return sigs
 
     def __str__(self):
@@ -258,10 +305,11 @@ class SerializedTactic(ExactMatch, Tactic):
         return self
 
     def __call__(self):
-        data = self.load(self.entity.open())
+        data = utils.load_document(self.entity, self.load)
         # self.data represents the product of previous layers
         if self.data:
-            data = utils.deepmerge(self.data, data)
+            # previous layers' data is shared, not modified
+            data = utils.merge(self.data, data)
 
         # Now apply any rules from config
         config = self.config
@@ -269,12 +317,10 @@ class SerializedTactic(ExactMatch, Tactic):
             section = config.get(self.section)
             if section:
                 dels = section.get('deletes', [])
-                if self.prefix:
-                    namespace = data[self.prefix]
-                else:
-                    namespace = data
                 for key in dels:
-                    utils.delete_path(key, namespace)
+                    if self.prefix:
+                        key = "{}.{}".format(self.prefix, key)
+                    data = utils.without_path(key, data)
         self.data = data
         if not self.target_file.parent.exists():
             self.target_file.parent.makedirs_p()
@@ -310,7 +356,7 @@ class ComposerYAML(YAMLTactic, ExactMatch):
     FILENAME = "composer.yaml"
 
     def read(self):
-        self._raw_data = self.load(self.entity.open())
+        self._raw_data = utils.load_document(self.entity, self.load)
 
     def __call__(self):
         # rewrite includes to be the current source
@@ -351,6 +397,18 @@ class ConfigYAML(MetadataYAML):
 
 
 class InstallerTactic(Tactic):
+    """pip install the requirement in a .pypi file into its directory.
+
+    pip installs into a staging directory of its own, on the pool when
+    there is one, and settle() moves the result into place replacing
+    what it installs over, as pip -U -t would. Installs sharing a
+    directory land in plan order and only the files an install put in
+    place are signed as its own.
+    """
+    _install = None
+    _staging = None
+    _installed = ()
+
     def __str__(self):
         return "Installing software to {}".format(self.relpath)
 
@@ -368,24 +426,74 @@ class InstallerTactic(Tactic):
         target_dir = target / path(spec.split(" ", 1)[0]).normpath().namebase
         log.debug("pip installing {} as {}".format(
             spec, target_dir))
-        utils.Process(("pip",
-                       "install",
-                       "-U",
-                       "-t",
-                       target,
-                       spec)).throw_on_error()()
-
-    def sign(self):
+        self._staging = path(tempfile.mkdtemp(prefix="composer-pip-"))
+        install = utils.Process(("pip",
+                                 "install",
+                                 "-U",
+                                 "-t",
+                                 self._staging,
+                                 spec)).throw_on_error()
+        if self.pool is None:
+            install()
+            self.settle()
+        else:
+            self._install = self.pool.submit(install)
+
+    def writes_to(self, directory):
+        # pip writes to the staging directory until settle()
+        return False
+
+    def pending(self):
+        if self._staging is None:
+            return None
+        return self.target_file.dirname()
+
+    def settle(self):
+        staging, self._staging = self._staging, None
+        if staging is None:
+            return
+        try:
+            if self._install is not None:
+                self._install.result()
+            target = self.target_file.dirname()
+            target.makedirs_p()
+            installed = []
+            for entry in sorted(staging.listdir()):
+                dest = target / entry.name
+                if dest.isdir() and not dest.islink():
+                    dest.rmtree()
+                else:
+                    dest.remove_p()
+                shutil.move(entry, dest)
+                if dest.isdir() and not dest.islink():
+                    installed.extend(sorted(dest.walkfiles()))
+                else:
+                    installed.append(dest)
+            self._installed = installed
+        finally:
+            staging.rmtree_p()
+
+    def sign(self, digests=None):
         """return sign in the form {relpath: (origin layer, SHA256)}
         """
+        self.settle()
+        digests = self._digester(digests)
         sigs = {}
-        for entry, sig in utils.walk(self.target_file.dirname(),
-                                     utils.sign, kind="files"):
+        for entry in self._installed:
+            if not entry.isfile():
+                continue
             relpath = entry.relpath(self._target.directory)
-            sigs[relpath] = (self.current.url, "dynamic", sig)
+            sigs[relpath] = (self.current.url, "dynamic", digests(entry))
         return sigs
 
 
+def _overlaps(target, directory):
+    """Whether target is directory, lies under it or holds it"""
+    target, directory = path(target).normpath(), path(directory).normpath()
+    return (target == directory or target.startswith(directory + "/") or
+            directory.startswith(target + "/"))
+
+
 def load_tactic(dpath, basedir):
     """Load a tactic from the current layer using a dotted path. The last
     element in the path should be a Tactic subclass
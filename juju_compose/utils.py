@@ -1,20 +1,32 @@
 import copy
 import collections
 import hashlib
+import imp
 import json
 import logging
+import marshal
+import multiprocessing
 import os
+import Queue
+import random
 import re
+import sched
+import stat
 import subprocess
 import sys
+import threading
 import time
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-from diff_match_patch import diff_match_patch
-import blessings
-import pathspec
+import diff
+import lazy
 from path import path
 
+blessings = lazy.LazyModule("blessings")
+pathspec = lazy.LazyModule("pathspec")
+yaml_comments = lazy.LazyModule("ruamel.yaml.comments")
+
 log = logging.getLogger('utils')
 
 
@@ -30,6 +42,51 @@ def cd(directory, make=False):
         os.chdir(cwd)
 
 
+def cache_dir(*parts):
+    """Directory for persistent caches, $COMPOSER_CACHE or the XDG user
+    cache directory"""
+    base = os.environ.get("COMPOSER_CACHE")
+    if not base:
+        base = os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or
+            os.path.expanduser("~/.cache"),
+            "juju-compose")
+    return path(base).joinpath(*parts)
+
+
+def expire(root, max_age, interval=600):
+    """Remove the files under root last written more than max_age seconds
+    ago, unless that was done in the last interval seconds as recorded by
+    root/.pruned. Returns True if it ran."""
+    root = path(root)
+    stamp = root / ".pruned"
+    now = time.time()
+    try:
+        if now - stamp.mtime < interval:
+            return False
+    except OSError:
+        pass
+    try:
+        root.makedirs_p()
+        stamp.touch()
+    except (IOError, OSError):
+        return False
+    cutoff = now - max_age
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            fn = os.path.join(dirpath, name)
+            try:
+                if os.stat(fn).st_mtime < cutoff:
+                    os.remove(fn)
+            except OSError:
+                # removed by someone else
+                pass
+    return True
+
+
+_MISSING = object()
+
+
 def deepmerge(dest, src):
     """
     Deep merge of two dicts.
@@ -53,7 +110,97 @@ def delete_path(path, obj):
     del obj[parts[-1]]
 
 
+def _shallow_copy(mapping):
+    """Copy one level of mapping keeping ruamel's comment and format
+    metadata. The copy gets its own comment table so comments changed on
+    it don't leak into mapping."""
+    if isinstance(mapping, NestedDict):
+        new = mapping.__class__()
+        dict.update(new, mapping)
+        return new
+    new = mapping.copy()
+    comment = getattr(mapping, yaml_comments.comment_attrib, None)
+    if comment is not None:
+        comment = copy.copy(comment)
+        comment._items = dict(comment.items)
+        setattr(new, yaml_comments.comment_attrib, comment)
+    return new
+
+
+def _key_comment(mapping, key):
+    comment = getattr(mapping, yaml_comments.comment_attrib, None)
+    if comment is not None:
+        return comment.items.get(key)
+    return None
+
+
+def merge(base, overlay):
+    """Persistent deep merge of two dicts.
+
+    Returns base updated with overlay without modifying either: only the
+    maps along the paths overlay changes are copied, every other subtree
+    is shared with base or overlay, so the result must be treated as
+    immutable too (see without_path). Comments on overlay's keys replace
+    those of base.
+    """
+    result = None
+    for k, v in overlay.iteritems():
+        old = base.get(k, _MISSING)
+        if old and isinstance(old, dict) and isinstance(v, dict):
+            v = merge(old, v)
+        elif type(old) is type(v) and not isinstance(v, (dict, list)) \
+                and old == v:
+            v = old
+        if v is old and _key_comment(overlay, k) is None:
+            continue
+        if result is None:
+            result = _shallow_copy(base)
+        result[k] = v
+        comment = _key_comment(overlay, k)
+        if comment is not None and hasattr(result, "copy_attributes"):
+            # result is our own copy, ca creates its comment table
+            result.ca.items[k] = comment
+    return base if result is None else result
+
+
+def without_path(path, obj):
+    """Persistent delete_path, returning a copy of obj without the dotted
+    path that shares everything off that path with obj"""
+    def remove(obj, parts):
+        new = _shallow_copy(obj)
+        if len(parts) == 1:
+            del new[parts[0]]
+            comment = getattr(new, yaml_comments.comment_attrib, None)
+            if comment is not None:
+                comment.items.pop(parts[0], None)
+        else:
+            new[parts[0]] = remove(obj[parts[0]], parts[1:])
+        return new
+    return remove(obj, path.split('.'))
+
+
+_key_parts = {}
+
+
+def _split_key(key):
+    parts = _key_parts.get(key)
+    if parts is None:
+        if len(_key_parts) > 65536:
+            _key_parts.clear()
+        parts = _key_parts[key] = tuple(key.split('.'))
+    return parts
+
+
 class NestedDict(dict):
+    """dict addressing nested dicts by dotted keys.
+
+    Dotted keys are split once and cached, and each NestedDict keeps a
+    flat index of the dotted keys looked up through it, found or missing.
+    The NestedDicts of one tree share a generation counter bumped by every
+    change made through them, which invalidates the indexes. Lookups
+    through plain dicts in the tree aren't indexed, changes to those can't
+    be seen.
+    """
     def __init__(self, dict_or_iterable=None, **kwargs):
         if dict_or_iterable:
             if isinstance(dict_or_iterable, dict):
@@ -64,37 +211,106 @@ class NestedDict(dict):
         if kwargs:
             self.update(kwargs)
 
+    def _generation(self):
+        # instances made by copy/pickle skip __init__
+        gen = self.__dict__.get('_gen')
+        if gen is None:
+            gen = self.__dict__['_gen'] = [0]
+        return gen
+
+    def _changed(self):
+        self._generation()[0] += 1
+
+    def _lookup(self, key, default):
+        attrs = self.__dict__
+        gen = attrs.get('_gen') or self._generation()
+        index = attrs.get('_index')
+        if index is None or index[0] != gen[0]:
+            # (generation, found values, missing keys)
+            index = attrs['_index'] = (gen[0], {}, set())
+        else:
+            value = index[1].get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            if key in index[2]:
+                return default
+        o = self
+        tracked = True
+        for part in _split_key(key):
+            if not isinstance(o, dict):
+                break
+            if tracked and not (isinstance(o, NestedDict) and
+                                o.__dict__.get('_gen') is gen):
+                tracked = False
+            o = dict.get(o, part, _MISSING)
+            if o is _MISSING:
+                break
+        else:
+            if tracked:
+                index[1][key] = o
+            return o
+        if tracked:
+            index[2].add(key)
+        return default
+
     def __setitem__(self, key, value):
-        key = key.split('.')
+        gen = self.__dict__.get('_gen') or self._generation()
+        # keys are mostly set once, caching the split doesn't pay here
+        parts = key.split('.')
         o = self
-        for part in key[:-1]:
-            o = o.setdefault(part, self.__class__())
-        dict.__setitem__(o, key[-1], value)
+        for part in parts[:-1]:
+            child = dict.get(o, part, _MISSING)
+            if child is _MISSING:
+                child = self.__class__()
+                child.__dict__['_gen'] = gen
+                dict.__setitem__(o, part, child)
+            o = child
+        dict.__setitem__(o, parts[-1], value)
+        gen[0] += 1
 
     def __getitem__(self, key):
-        o = self
-        if '.' in key:
-            parts = key.split('.')
-            key = parts[-1]
-            for part in parts[:-1]:
-                o = o[part]
+        value = self._lookup(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
 
-        return dict.__getitem__(o, key)
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
 
     def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(key)
+        # top level names need neither splitting nor the index
+        value = dict.get(self, key, _MISSING)
+        if value is _MISSING:
+            if key.startswith('__') or key in ('_gen', '_index'):
+                raise AttributeError(key)
+            value = self._lookup(key, _MISSING)
+            if value is _MISSING:
+                raise AttributeError(key)
+        return value
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+        return self._lookup(key, default)
 
     def update(self, other):
         deepmerge(self, other)
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, *args):
+        self._changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+    def clear(self):
+        self._changed()
+        dict.clear(self)
 
 
 class ProcessResult(object):
@@ -140,7 +356,107 @@ class ProcessResult(object):
                 self.exit_code, self.command, output=self.output)
 
 
+class ProcessCancelled(Exception):
+    pass
+
+
+class RunningProcess(object):
+    """A started Process.
+
+    stdout and stderr are read line by line as they arrive by a thread
+    each, logged at debug and kept for the ProcessResult. With max_output
+    only the last max_output lines of each are kept. After timeout
+    seconds, or on cancel(), the process is terminated and then killed if
+    it hasn't exited KILL_AFTER seconds later.
+    """
+    KILL_AFTER = 5
+
+    def __init__(self, command, log=log, timeout=None, max_output=None,
+                 **kwargs):
+        self.command = command
+        self.log = log
+        self.timed_out = False
+        self.cancelled = False
+        self.popen = subprocess.Popen(command, **kwargs)
+        self._output = {}
+        self._readers = []
+        for name in ("stdout", "stderr"):
+            fp = getattr(self.popen, name)
+            if fp is None:
+                continue
+            lines = self._output[name] = collections.deque(maxlen=max_output)
+            reader = threading.Thread(target=self._read, args=(fp, lines))
+            reader.daemon = True
+            reader.start()
+            self._readers.append(reader)
+        self._timer = None
+        self._killer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _read(self, fp, lines):
+        for line in iter(fp.readline, b""):
+            lines.append(line)
+            self.log.debug(line.rstrip("\n"))
+        fp.close()
+
+    def _expire(self):
+        self.timed_out = True
+        self.log.debug("process: %s timed out", " ".join(self.command))
+        self._stop()
+
+    def _kill(self):
+        # the pid may have been reaped and reused since
+        if self.popen.returncode is not None:
+            return
+        try:
+            self.popen.kill()
+        except OSError:
+            pass
+
+    def _stop(self):
+        if self.popen.poll() is not None:
+            return
+        try:
+            self.popen.terminate()
+        except OSError:
+            return
+        if self._killer is None:
+            self._killer = threading.Timer(self.KILL_AFTER, self._kill)
+            self._killer.daemon = True
+            self._killer.start()
+
+    def cancel(self):
+        self.cancelled = True
+        self._stop()
+
+    def wait(self):
+        """Wait for the process to exit and return its ProcessResult"""
+        exit_code = self.popen.wait()
+        for timer in (self._timer, self._killer):
+            if timer:
+                timer.cancel()
+        for reader in self._readers:
+            reader.join()
+        output = dict((name, "".join(lines).strip())
+                      for name, lines in self._output.items())
+        result = ProcessResult(self.command, exit_code,
+                               output.get("stdout"), output.get("stderr"))
+        result.timed_out = self.timed_out
+        result.cancelled = self.cancelled
+        self.log.debug("process: %s (%d)", result.cmd, result.exit_code)
+        return result
+
+
 class Process(object):
+    """A command to run, calling it runs the command with extra args and
+    returns a ProcessResult.
+
+    Keyword arguments are passed to subprocess.Popen except timeout and
+    max_output, see RunningProcess.
+    """
     def __init__(self, command=None, throw=False, log=log, **kwargs):
         if isinstance(command, str):
             command = (command, )
@@ -156,7 +472,8 @@ class Process(object):
         self._throw_on_error = throw
         return self
 
-    def __call__(self, *args, **kw):
+    def start(self, *args, **kw):
+        """Start the command returning its RunningProcess"""
         kwargs = dict(stdout=subprocess.PIPE,
                       stderr=subprocess.STDOUT)
         if self._kw:
@@ -168,21 +485,119 @@ class Process(object):
             all_args = args
         if 'env' not in kwargs:
             kwargs['env'] = os.environ
+        return RunningProcess(all_args, log=self.log, **kwargs)
 
-        p = subprocess.Popen(all_args, **kwargs)
-        stdout, stderr = p.communicate()
-        self.log.debug(stdout)
-        stdout = stdout.strip()
-        if stderr is not None:
-            stderr = stderr.strip()
-            self.log.debug(stderr)
-        exit_code = p.poll()
-        result = ProcessResult(all_args, exit_code, stdout, stderr)
-        self.log.debug("process: %s (%d)", result.cmd, result.exit_code)
+    def __call__(self, *args, **kw):
+        result = self.start(*args, **kw).wait()
         if self._throw_on_error:
             result.throw_on_error()
         return result
 
+
+class ProcessJob(object):
+    """A Process call submitted to a ProcessPool"""
+    def __init__(self, process, args, kwargs):
+        self.process = process
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._running = None
+        self._result = None
+        self._error = None
+
+    def run(self):
+        try:
+            with self._lock:
+                if self.cancelled:
+                    return
+                self._running = self.process.start(*self.args,
+                                                   **self.kwargs)
+            self._result = self._running.wait()
+            if self.process._throw_on_error:
+                self._result.throw_on_error()
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def cancel(self):
+        """Drop the job if it hasn't started, stop it if it has"""
+        with self._lock:
+            self.cancelled = True
+            running = self._running
+        if running:
+            running.cancel()
+        else:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the job and return its ProcessResult, raising what the
+        call raised or ProcessCancelled"""
+        if not self._done.wait(timeout):
+            raise OSError("Timeout waiting for {}".format(self.process))
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        if self.cancelled:
+            raise ProcessCancelled(self.process)
+        return self._result
+
+
+class ProcessPool(object):
+    """Run Process calls concurrently, at most limit at a time"""
+    def __init__(self, limit=None):
+        self.limit = limit or multiprocessing.cpu_count()
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._jobs = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, process, *args, **kwargs):
+        """Queue a call of process returning its ProcessJob"""
+        job = ProcessJob(process, args, kwargs)
+        self._jobs = [j for j in self._jobs if not j.done()] + [job]
+        if len(self._workers) < self.limit:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._queue.put(job)
+        return job
+
+    def map(self, process, argslist):
+        """Call process with each tuple of args, returning the results in
+        order"""
+        jobs = [self.submit(process, *args) for args in argslist]
+        return [job.result() for job in jobs]
+
+    def shutdown(self, cancel=False):
+        """Stop the workers once the queue is done, first cancelling every
+        job with cancel"""
+        if cancel:
+            for job in self._jobs:
+                job.cancel()
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown(cancel=exc_type is not None)
+
 command = Process
 
 
@@ -210,44 +625,122 @@ dig = Process(('dig', '+short'))
 api_endpoints = Process(('juju', 'api-endpoints'))
 
 
+def _clock_gettime():
+    # the CLOCK_MONOTONIC id below is Linux's
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long),
+                        ("tv_nsec", ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or
+                            ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    except (ImportError, OSError, AttributeError):
+        return None
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time.time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+# seconds from an arbitrary point that never goes backwards, time.time()
+# where the platform has no monotonic clock
+monotonic = _clock_gettime() or time.time
+
+
+class Backoff(object):
+    """Exponential backoff delays: initial, then multiplied by factor up
+    to maximum, each varied by up to +/- jitter of itself so concurrent
+    waiters spread out"""
+    def __init__(self, initial=0.1, maximum=20, factor=2, jitter=0.1):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+
+    def __iter__(self):
+        delay = min(self.initial, self.maximum)
+        while True:
+            yield delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            delay = min(delay * self.factor, self.maximum)
+
+
+class Watcher(object):
+    """Wait for many conditions at once.
+
+    Each condition is a callable polled on its own Backoff schedule by a
+    single sched.scheduler on the monotonic clock until it returns True.
+    Conditions run in the calling thread, interleaved by their schedules.
+    """
+    def __init__(self):
+        self.conditions = []
+
+    def add(self, callback, backoff=None):
+        self.conditions.append((callback, backoff or Backoff()))
+        return self
+
+    def wait(self, timeout=0):
+        """Poll the conditions until all have passed, raising OSError if
+        that takes more than timeout seconds (0 waits forever)"""
+        scheduler = sched.scheduler(monotonic, time.sleep)
+        pending = set(range(len(self.conditions)))
+        state = {}
+
+        def expire():
+            raise OSError("Timeout exceeded in wait_for")
+
+        def attempt(i, delays):
+            callback = self.conditions[i][0]
+            if callback():
+                pending.discard(i)
+                if not pending and 'deadline' in state:
+                    scheduler.cancel(state['deadline'])
+                return
+            scheduler.enter(next(delays), 1, attempt, (i, delays))
+
+        if timeout:
+            state['deadline'] = scheduler.enter(timeout, 0, expire, ())
+        for i, (callback, backoff) in enumerate(self.conditions):
+            scheduler.enter(0, 1, attempt, (i, iter(backoff)))
+        scheduler.run()
+        return True
+
+
 def wait_for(timeout, interval, *callbacks, **kwargs):
     """
     Repeatedly try callbacks until all return True
 
-    This will wait interval seconds between attempts and will error out
-    after timeout has been exceeded.
-
-    Callbacks will be called with the container as their argument.
+    The first attempt is immediate, after which the delay between attempts
+    backs off exponentially from `initial` (0.1 by default) to interval
+    seconds. This will error out after timeout has been exceeded.
 
     Setting timeout to zero will loop until cancelled, power runs outs,
     hardware fails, or the heat death of the universe.
     """
-    start = time.time()
-    if timeout:
-        end = start + timeout
-    else:
-        end = 0
-
     bar = kwargs.get('bar', None)
     message = kwargs.get('message', None)
-    once = 1
-    while True:
-        passes = True
-        if end > 0 and time.time() > end:
-            raise OSError("Timeout exceeded in wait_for")
+    attempts = [0]
+
+    def check():
         if bar:
-            bar.next(once, message=message)
-            if once == 1:
-                once = 0
-        if int(time.time()) % interval == 0:
-            for callback in callbacks:
-                result = callback()
-                passes = passes & bool(result)
-                if passes is False:
-                    break
-            if passes is True:
-                break
-        time.sleep(1)
+            bar.next(attempts[0] == 0, message=message)
+        attempts[0] += 1
+        for callback in callbacks:
+            if not callback():
+                return False
+        return True
+
+    backoff = Backoff(initial=kwargs.get('initial', 0.1), maximum=interval)
+    return Watcher().add(check, backoff).wait(timeout)
 
 
 def until(*callbacks, **kwargs):
@@ -257,16 +750,33 @@ def until(*callbacks, **kwargs):
 def retry(attempts, *callbacks, **kwargs):
     """
     Repeatedly try callbacks a fixed number of times or until all return True
+
+    With a delay the attempts are spaced by a Backoff starting at delay
+    seconds up to max_delay.
     """
-    for attempt in xrange(attempts):
+    delay = kwargs.get('delay', 0)
+    delays = iter(Backoff(initial=delay,
+                          maximum=kwargs.get('max_delay', delay * 2 ** 5)))
+    scheduler = sched.scheduler(monotonic, time.sleep)
+    outcome = []
+
+    def attempt(n):
         if 'bar' in kwargs:
-            kwargs['bar'].next(attempt == 0, message=kwargs.get('message'))
+            kwargs['bar'].next(n == 0, message=kwargs.get('message'))
         for callback in callbacks:
             if not callback():
                 break
         else:
-            break
-    else:
+            outcome.append(True)
+            return
+        if n + 1 < attempts:
+            scheduler.enter(next(delays) if delay else 0, 0, attempt,
+                            (n + 1,))
+
+    if attempts > 0:
+        scheduler.enter(0, 0, attempt, (0,))
+    scheduler.run()
+    if not outcome:
         raise OSError("Retry attempts exceeded")
     return True
 
@@ -288,24 +798,80 @@ def which(program):
     return None
 
 
+_code_cache = {}
+_class_cache = {}
+_load_lock = threading.RLock()
+
+
+# bytecode not written for this long is dropped from the user cache
+BYTECODE_MAX_AGE = 30 * 24 * 3600
+
+
+def compile_module(filename):
+    """Compile the python source at filename, caching the code object by
+    digest of the source in memory and as marshalled bytecode under the
+    user cache"""
+    filename = path(filename).abspath()
+    source = filename.bytes()
+    key = hashlib.sha256("{}\0{}\0".format(
+        imp.get_magic().encode("hex"), filename))
+    key.update(source)
+    key = key.hexdigest()
+    with _load_lock:
+        code = _code_cache.get(key)
+        if code is not None:
+            return code
+        cached = path(cache_dir("bytecode", key[:2], key))
+        try:
+            code = marshal.loads(cached.bytes())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            code = compile(source, filename, "exec")
+            try:
+                cached.dirname().makedirs_p()
+                tmp = cached + ".tmp"
+                path(tmp).write_bytes(marshal.dumps(code))
+                os.rename(tmp, cached)
+                expire(cache_dir("bytecode"), BYTECODE_MAX_AGE)
+            except (IOError, OSError):
+                pass
+        _code_cache[key] = code
+        return code
+
+
 def load_class(dpath, workingdir=None):
+    """Load the class named by the dotted path dpath, the module part
+    being relative to workingdir (by default the current directory).
+
+    The module is run in a fresh module namespace and the class memoized
+    per (workingdir, dpath) until the module file changes.
+    """
     # we expect the last element of the path
-    if not workingdir:
-        workingdir = os.getcwd()
-    with cd(workingdir):
-        modpath, classname = dpath.rsplit('.', 1)
-        modpath = path(modpath.replace(".", "/"))
-        if not modpath.exists():
-            modpath += ".py"
-        if not modpath.exists():
-            raise OSError("Unable to load {} from {}".format(
-                dpath, workingdir))
-        namespace = {}
-        execfile(modpath, globals(), namespace)
-        klass = namespace.get(classname)
+    workingdir = path(workingdir or os.getcwd()).abspath()
+    modname, classname = dpath.rsplit('.', 1)
+    modpath = workingdir / modname.replace(".", "/")
+    if not modpath.exists():
+        modpath += ".py"
+    if not modpath.exists():
+        raise OSError("Unable to load {} from {}".format(
+            dpath, workingdir))
+    fingerprint = stat_fingerprint(modpath.stat())
+    with _load_lock:
+        cached = _class_cache.get((workingdir, dpath))
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        module = imp.new_module(modname)
+        module.__file__ = modpath
+        # not part of a package, so imports in it don't look for a
+        # parent module named after the dotted path
+        module.__package__ = ''
+        exec compile_module(modpath) in module.__dict__
+        klass = getattr(module, classname, None)
         if klass is None:
             raise ImportError("Unable to load class {} at {}".format(
                 classname, dpath))
+        # the module is kept too, Python 2 clears the globals of a module
+        # once it is collected, breaking the class's methods
+        _class_cache[(workingdir, dpath)] = (fingerprint, klass, module)
         return klass
 
 
@@ -329,8 +895,22 @@ def walk(pathobj, fn, matcher=None, kind=None, **kwargs):
         yield (entry, fn(entry, **kwargs))
 
 
+_ignore_specs = {}
+
+
+def ignore_spec(ignores):
+    """The compiled gitignore style PathSpec for ignores, compiled once
+    per process"""
+    key = tuple(ignores)
+    spec = _ignore_specs.get(key)
+    if spec is None:
+        spec = pathspec.PathSpec.from_lines(pathspec.GitIgnorePattern, key)
+        _ignore_specs[key] = spec
+    return spec
+
+
 def ignore_matcher(ignores=[]):
-    spec = pathspec.PathSpec.from_lines(pathspec.GitIgnorePattern, ignores)
+    spec = ignore_spec(ignores)
 
     def matcher(entity):
         return entity not in spec.match_files((entity,))
@@ -344,38 +924,184 @@ def sign(pathobj):
     return hashlib.sha256(p.bytes()).hexdigest()
 
 
-def delta_signatures(manifest_filename, ignorer=None):
-    md = path(manifest_filename)
-    repo = md.normpath().dirname()
+def stat_fingerprint(st):
+    """Return (size, mtime_ns, inode) for an os.stat result"""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return st.st_size, mtime_ns, st.st_ino
 
-    baseline = json.load(md.open())
-    current = {}
-    for rel, sig in walk(repo, sign):
-        rel = rel.relpath(repo)
-        current[rel] = sig
-    add, change, delete = set(), set(), set()
 
-    for p, s in current.items():
-        fp = repo / p
-        if not fp.isfile():
-            continue
-        if ignorer and not ignorer(p):
-            continue
+class DigestRegistry(object):
+    """Build scoped cache of file digests.
 
-        if p not in baseline["signatures"]:
-            add.add(p)
-            continue
-        # layer, kind, sig
-        # don't include items generated only for the last layer
-        if baseline["signatures"][p][0] == "composer":
-            continue
-        if baseline["signatures"][p][2] != s:
-            change.add(p)
+    Digests are keyed by (path, size, mtime_ns, inode) so that each
+    distinct file is only hashed once no matter how many tactics sign
+    it. Instances are callable with the same contract as `sign`.
+    """
+    def __init__(self):
+        self._digests = {}
+        self._lock = threading.Lock()
+        self.hashed = 0
+
+    def __len__(self):
+        return len(self._digests)
 
-    for p, d in baseline["signatures"].items():
-        if p not in current:
-            delete.add(path(p))
-    return add, change, delete
+    def sign(self, pathobj):
+        p = path(pathobj)
+        try:
+            st = os.stat(p)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        key = p.abspath()
+        fingerprint = stat_fingerprint(st)
+        cached = self._digests.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        digest = sign(p)
+        with self._lock:
+            self.hashed += 1
+            self._digests[key] = (fingerprint, digest)
+        return digest
+
+    __call__ = sign
+
+    def forget_recent(self, seconds):
+        """Drop the digests of files modified within the last seconds,
+        their mtime could still change without the fingerprint noticing.
+        Registries kept across builds call this between them"""
+        horizon = (time.time() - seconds) * 1e9
+        with self._lock:
+            for key, (fingerprint, digest) in self._digests.items():
+                if fingerprint[1] >= horizon:
+                    del self._digests[key]
+
+
+class DocumentCache(object):
+    """Parsed YAML and JSON documents keyed by path and stat fingerprint.
+
+    Each load returns a deep copy of the cached document so callers are
+    free to modify it.
+    """
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.Lock()
+        self.parsed = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def load(self, filename, loader):
+        p = path(filename)
+        st = os.stat(p)
+        # bound methods are made per instance, key on their function
+        key = (p.abspath(), getattr(loader, "__func__", loader))
+        fingerprint = stat_fingerprint(st)
+        cached = self._documents.get(key)
+        if cached is None or cached[0] != fingerprint:
+            with open(p) as fp:
+                document = loader(fp)
+            with self._lock:
+                self.parsed += 1
+                self._documents[key] = cached = (fingerprint, document)
+        return copy.deepcopy(cached[1])
+
+    def forget_recent(self, seconds):
+        """See DigestRegistry.forget_recent"""
+        horizon = (time.time() - seconds) * 1e9
+        with self._lock:
+            for key, (fingerprint, document) in self._documents.items():
+                if fingerprint[1] >= horizon:
+                    del self._documents[key]
+
+
+# a DocumentCache installed by long running processes, see load_document
+documents = None
+
+
+def load_document(filename, loader):
+    """Parse filename with loader(fp), through the documents cache when
+    one is installed"""
+    if documents is not None:
+        return documents.load(filename, loader)
+    with open(filename) as fp:
+        return loader(fp)
+
+
+class PersistentDigestRegistry(DigestRegistry):
+    """A DigestRegistry saved to filename between runs.
+
+    Entries for files modified within RACY seconds of saving are not
+    written, their mtime could still change without the fingerprint
+    noticing.
+    """
+    RACY = 2
+
+    def __init__(self, filename):
+        super(PersistentDigestRegistry, self).__init__()
+        self.filename = path(filename)
+        self._dirty = False
+        if self.filename.exists():
+            try:
+                data = json.loads(self.filename.text())
+            except ValueError:
+                data = {}
+            for key, (size, mtime_ns, ino, digest) in data.items():
+                self._digests[key] = ((size, mtime_ns, ino), digest)
+
+    @classmethod
+    def for_directory(cls, directory):
+        """The registry kept for directory in the user cache"""
+        key = hashlib.sha1(path(directory).abspath()).hexdigest()
+        return cls(cache_dir("digests", key + ".json"))
+
+    def sign(self, pathobj):
+        hashed = self.hashed
+        digest = super(PersistentDigestRegistry, self).sign(pathobj)
+        if self.hashed != hashed:
+            self._dirty = True
+        return digest
+
+    __call__ = sign
+
+    def save(self):
+        if not self._dirty:
+            return
+        horizon = (time.time() - self.RACY) * 1e9
+        data = {}
+        for key, (fingerprint, digest) in self._digests.items():
+            if fingerprint[1] < horizon:
+                data[key] = list(fingerprint) + [digest]
+        self.filename.dirname().makedirs_p()
+        tmp = self.filename + ".tmp"
+        path(tmp).write_text(json.dumps(data))
+        os.rename(tmp, self.filename)
+        self._dirty = False
+
+
+def sign_all(paths, digests=None, jobs=None):
+    """Hash paths using a pool of jobs threads yielding (path, digest)
+    in the order given. hashlib releases the GIL while hashing so this
+    scales with the available disk bandwidth and cores.
+    """
+    if digests is None:
+        digests = sign
+    paths = list(paths)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(paths))
+    if jobs <= 1:
+        for p in paths:
+            yield p, digests(p)
+        return
+    pool = ThreadPool(jobs)
+    try:
+        for p, digest in zip(paths, pool.imap(digests, paths)):
+            yield p, digest
+    finally:
+        pool.terminate()
 
 
 class ColoredFormatter(logging.Formatter):
@@ -428,57 +1154,62 @@ REACTIVE_PATTERNS = [
 ]
 
 
-def delta_python(orig, dest, patterns=REACTIVE_PATTERNS, context=2):
-    """Delta two python files looking for certain patterns"""
-    if isinstance(orig, path):
-        od = orig.text()
-    elif hasattr(orig, 'read'):
-        od = orig.read()
-    else:
-        raise TypeError("Expected path() or file(), got %s" % type(orig))
-    if isinstance(dest, path):
-        dd = dest.text()
-    elif hasattr(orig, 'read'):
-        dd = dest.read()
-    else:
-        raise TypeError("Expected path() or file(), got %s" % type(dest))
+def _read_source(source):
+    if isinstance(source, path):
+        return source.text()
+    elif hasattr(source, 'read'):
+        return source.read()
+    raise TypeError("Expected path() or file(), got %s" % type(source))
+
+
+def delta_python(orig, dest, patterns=REACTIVE_PATTERNS, context=2,
+                 backend=None):
+    """Delta two python files looking for certain patterns.
+
+    The files are diffed line by line with backend (a name or instance
+    from juju_compose.diff) and only the changed hunks, with the context
+    lines before them, are searched for patterns. Yields [lineno, last,
+    current] for each matching hunk where lineno is the line of dest the
+    hunk starts at, last the preceding (DIFF_EQUAL, text) segment or None
+    and current the (op, text) hunk.
+    """
+    od = _read_source(orig)
+    dd = _read_source(dest)
+    if od == dd:
+        return
 
-    differ = diff_match_patch()
     linect = 0
     lastMatch = None
-    for res in differ.diff_main(od, dd):
-        if res[0] == diff_match_patch.DIFF_EQUAL:
+    for res in diff.get_backend(backend).diff(od, dd):
+        if res[0] == diff.EQUAL:
             linect += res[1].count('\n')
-            lastMatch = res[:]
+            lastMatch = res
             continue
-        elif res[0] == diff_match_patch.DIFF_INSERT:
-            linect += res[1].count('\n')
-        else:
-            linect -= res[1].count('\n')
-
+        scan = res[1].splitlines()
+        if lastMatch and context:
+            scan = lastMatch[1].splitlines()[-context:] + scan
         for p in patterns:
-            if p.search(lastMatch[1]):
-                yield [linect, lastMatch, res]
+            if any(p.search(l) for l in scan):
+                yield [linect + 1, lastMatch, res]
                 break
+        if res[0] == diff.INSERT:
+            linect += res[1].count('\n')
 
 
 def delta_python_dump(orig, dest, patterns=REACTIVE_PATTERNS,
                       context=2, term=None,
-                      from_name=None, to_name=None):
+                      from_name=None, to_name=None, backend=None):
+    return write_delta(delta_python(orig, dest, patterns, context, backend),
+                       from_name or orig, to_name or dest,
+                       context=context, term=term)
+
+
+def write_delta(hunks, orig_name, dest_name, context=2, term=None):
+    """Render the hunks of delta_python, returning True if there were
+    none"""
     if term is None:
         term = TermWriter()
 
-    def norm_sources(orig, dest):
-        if from_name:
-            oname = from_name
-        else:
-            oname = orig
-        if to_name:
-            dname = to_name
-        else:
-            dname = dest
-        return _O({'orig_name': oname, 'dest_name': dname})
-
     def prefix_lines(lines, lineno):
         if isinstance(lines, str):
             lines = lines.splitlines()
@@ -487,17 +1218,21 @@ def delta_python_dump(orig, dest, patterns=REACTIVE_PATTERNS,
         return "\n".join(lines)
 
     i = 0
-    for lineno, last, current in delta_python(orig, dest, patterns, context):
+    for lineno, last, current in hunks:
         # pull enough context
-        if last:
+        context_lines = []
+        if last and context:
             context_lines = last[1].splitlines()[-context:]
-        message = norm_sources(orig, dest)
-        message['context'] = prefix_lines(context_lines, lineno - context)
+        message = _O({'orig_name': orig_name, 'dest_name': dest_name})
+        message['context'] = prefix_lines(context_lines,
+                                          lineno - len(context_lines))
+        if context_lines:
+            message['context'] += "\n"
         message['lineno'] = lineno
-        message['delta'] = current[1]
-        s = {diff_match_patch.DIFF_EQUAL: term.normal,
-             diff_match_patch.DIFF_INSERT: term.green,
-             diff_match_patch.DIFF_DELETE: term.red}[current[0]]
+        message['delta'] = current[1].rstrip('\n')
+        s = {diff.EQUAL: term.normal,
+             diff.INSERT: term.green,
+             diff.DELETE: term.red}[current[0]]
         message['status_color'] = s
         # output message
         term.write("{t.bold}{m.orig_name}{t.normal} --> "
@@ -0,0 +1,197 @@
+"""Watch directory trees for changes.
+
+InotifyWatcher uses Linux inotify through ctypes, watching every
+directory of the trees and the ones created later. PollingWatcher
+compares stat snapshots of the trees instead and is used where inotify
+isn't available. Both report changes through
+
+    watcher.changes(timeout)
+
+returning the set of changed paths (files or directories, a changed
+directory standing for everything under it), an empty set when nothing
+changed within timeout seconds or None when changes were lost and the
+trees should be considered changed throughout.
+"""
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+import utils
+
+log = logging.getLogger("composer")
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT = struct.Struct("iIII")
+
+
+def _libc():
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher(object):
+    BUFSIZE = 65536
+
+    def __init__(self, directories):
+        self.libc = _libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = self._errno()
+            raise OSError(code, os.strerror(code))
+        self.watches = {}
+        for directory in directories:
+            self._add_tree(directory)
+
+    def _errno(self):
+        import ctypes
+        return ctypes.get_errno()
+
+    def _add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, str(directory), MASK)
+        if wd < 0:
+            code = self._errno()
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                # gone before we got to it
+                return
+            raise OSError(code, os.strerror(code), directory)
+        self.watches[wd] = directory
+
+    def _add_tree(self, directory):
+        """Watch directory and those under it, returning its files"""
+        found = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            self._add(dirpath)
+            found.extend(os.path.join(dirpath, f) for f in filenames)
+        return found
+
+    def fileno(self):
+        return self.fd
+
+    def changes(self, timeout=None):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        try:
+            data = os.read(self.fd, self.BUFSIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            p = os.path.join(directory, name) if name else directory
+            changed.add(p)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # files may have landed before the watch was in place
+                changed.update(self._add_tree(p))
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PollingWatcher(object):
+    def __init__(self, directories, interval=1.0):
+        self.directories = list(directories)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                for name in filenames:
+                    p = os.path.join(dirpath, name)
+                    try:
+                        st = os.lstat(p)
+                    except OSError:
+                        continue
+                    snapshot[p] = utils.stat_fingerprint(st) + (st.st_mode,)
+        return snapshot
+
+    def changes(self, timeout=None):
+        deadline = None if timeout is None else utils.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, max(0, deadline - utils.monotonic()))
+            time.sleep(delay)
+            snapshot = self._scan()
+            old, self._snapshot = self._snapshot, snapshot
+            changed = set(p for p in set(old) | set(snapshot)
+                          if old.get(p) != snapshot.get(p))
+            if changed or (deadline is not None and
+                           utils.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+def watcher(directories, interval=1.0):
+    """An InotifyWatcher on directories, or a PollingWatcher checking
+    every interval seconds where inotify isn't available"""
+    try:
+        return InotifyWatcher(directories)
+    except OSError as e:
+        log.debug("Polling for changes, inotify failed: %s", e)
+        return PollingWatcher(directories, interval)
+
+
+def batches(watcher, quiet=0.2, timeout=None):
+    """Yield the paths changed in each burst of changes, a burst ending
+    once nothing changed for quiet seconds. Yields None for lost changes
+    and an empty set when nothing changed within timeout seconds"""
+    while True:
+        batch = watcher.changes(timeout)
+        while batch:
+            more = watcher.changes(quiet)
+            if more is None:
+                batch = None
+            elif not more:
+                break
+            else:
+                batch |= more
+        yield batch
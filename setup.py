@@ -13,6 +13,7 @@ setup(
         'console_scripts': [
             'juju-compose = juju_compose:main',
             'juju-inspect = juju_compose:inspect',
+            'juju-compose-cache = juju_compose.cacheserver:main',
         ]
     }
 )
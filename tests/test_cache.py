@@ -0,0 +1,147 @@
+import json
+import tempfile
+import threading
+import unittest
+
+import requests
+from path import path
+from juju_compose import utils
+from juju_compose.cache import BuildCache, RemoteCache, break_hardlinks
+from juju_compose.cacheserver import CacheServer
+from juju_compose.manifest import Entry, Manifest
+
+
+class TestBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        self.tmp.rmtree_p()
+
+    def build(self, name, content):
+        out = self.tmp / name
+        out.makedirs_p()
+        sigs = {}
+        for rel, data in content.items():
+            (out / rel).write_text(data)
+            sigs[rel] = Entry("layer", "static", utils.sign(out / rel),
+                              None, None)
+        return out, Manifest(["layer", "composer"], sigs)
+
+    def test_store_restore(self):
+        cache = BuildCache(self.tmp / "cache")
+        out, manifest = self.build("a", {"x": "shared", "y": "only a"})
+        cache.store("a", out, manifest)
+        self.assertIsNone(cache.restore("missing", self.tmp / "r"))
+
+        restored = cache.restore("a", self.tmp / "r")
+        self.assertEqual((self.tmp / "r" / "y").text(), "only a")
+        self.assertEqual(restored["x"].sha256, manifest["x"].sha256)
+        self.assertEqual(restored["x"].size, 6)
+
+        break_hardlinks(self.tmp / "r", restored.signatures)
+        self.assertEqual((self.tmp / "r" / "x").stat().st_nlink, 1)
+        (self.tmp / "r" / "x").write_text("edited")
+        self.assertIsNotNone(cache.restore("a", self.tmp / "r2"))
+
+        # writing through a hardlinked output invalidates the blob
+        (self.tmp / "r2" / "x").write_text("edited")
+        self.assertIsNone(cache.restore("a", self.tmp / "r3"))
+        self.assertFalse(cache.has_blob(manifest["x"].sha256))
+
+    def test_unsafe_paths(self):
+        cache = BuildCache(self.tmp / "cache")
+        out, manifest = self.build("a", {"x": "shared"})
+        sha = manifest["x"].sha256
+        cache.store("a", out, manifest)
+        for rel in ("../escaped", "/tmp/escaped", "a/../../escaped"):
+            self.assertRaises(ValueError, cache.put, "bad", dict(
+                layers=["layer"], files=[[rel, "layer", "static", sha,
+                                          0644, [6, 0]]]))
+            # records written behind the cache's back aren't restored
+            record = cache.get("a")
+            record["files"][0][0] = rel
+            cache.record_path("a").write_text(json.dumps(record))
+            self.assertIsNone(cache.restore("a", self.tmp / "r" / "out"))
+            self.assertFalse((self.tmp / "r" / "escaped").exists())
+        manifest.signatures["../x"] = manifest["x"]
+        self.assertRaises(ValueError, cache.store, "b", out, manifest)
+
+        # nor through a symlinked directory of the output
+        (out / "link").mkdir()
+        (out / "link" / "x").write_text("shared")
+        cache.store("a", out, Manifest(manifest.layers,
+                                       {"link/x": manifest["x"]}))
+        (self.tmp / "r2").mkdir()
+        (self.tmp / "outside").mkdir()
+        (self.tmp / "outside").symlink(self.tmp / "r2" / "link")
+        self.assertIsNone(cache.restore("a", self.tmp / "r2"))
+        self.assertFalse((self.tmp / "outside" / "x").exists())
+
+    def test_prune(self):
+        cache = BuildCache(self.tmp / "cache", max_size=15)
+        out, manifest = self.build("a", {"x": "shared", "y": "only a"})
+        cache.store("a", out, manifest)
+        cache.record_path("a").utime((0, 0))
+        out, manifest = self.build("b", {"x": "shared", "z": "only b"})
+        cache.store("b", out, manifest)
+        # pruned at most every PRUNE_INTERVAL
+        self.assertIsNotNone(cache.get("a"))
+        self.assertFalse(cache.maybe_prune())
+        # orphaned blobs are kept for a while, they may be uploads
+        cache.prune()
+        self.assertTrue(cache.has_blob(utils.sign(self.tmp / "a" / "y")))
+        cache.prune(grace=0)
+
+        # a was least recently used and is evicted with its own blob
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertTrue(cache.has_blob(utils.sign(out / "x")))
+        self.assertFalse(cache.has_blob(utils.sign(self.tmp / "a" / "y")))
+
+    def test_remote(self):
+        server = CacheServer(("127.0.0.1", 0),
+                             BuildCache(self.tmp / "server"))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            remote = RemoteCache(server.url)
+            key = "1" * 64
+            agent1 = BuildCache(self.tmp / "agent1")
+            out, manifest = self.build("a", {"x": "shared", "y": "only a"})
+            agent1.store(key, out, manifest)
+            self.assertFalse(remote.fetch(key, agent1))
+            remote.push(key, agent1)
+            self.assertEqual(remote.missing([manifest["x"].sha256]), [])
+
+            agent2 = BuildCache(self.tmp / "agent2")
+            agent2.add_blob(manifest["x"].sha256, out / "x")
+            self.assertTrue(remote.fetch(key, agent2))
+            restored = agent2.restore(key, self.tmp / "r")
+            self.assertEqual(restored["y"].sha256, manifest["y"].sha256)
+            self.assertEqual((self.tmp / "r" / "y").text(), "only a")
+
+            # the server refuses blobs that don't match their address
+            r = requests.put(server.url + "/blobs/" + "0" * 64, data="nope")
+            self.assertEqual(r.status_code, 400)
+            self.assertEqual(remote.missing(["0" * 64]), ["0" * 64])
+
+            # records with unsafe paths are refused on both ends
+            record = agent1.get(key)
+            bad = dict(layers=record["layers"],
+                       files=[["../escaped"] + record["files"][0][1:5]])
+            r = requests.put(server.url + "/builds/" + "2" * 64,
+                             data=json.dumps(bad))
+            self.assertEqual(r.status_code, 400)
+            server.cache.record_path("3" * 64).write_text(json.dumps(bad))
+            agent3 = BuildCache(self.tmp / "agent3")
+            self.assertFalse(remote.fetch("3" * 64, agent3))
+            self.assertFalse(agent3.has_blob(record["files"][0][3]))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
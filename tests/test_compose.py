@@ -1,12 +1,21 @@
+import base64
+import hashlib
 from path import path
 from ruamel import yaml
 import json
 import juju_compose
+from juju_compose import utils
+from juju_compose.cache import BuildCache
+from juju_compose.cacheserver import CacheServer
+from juju_compose.manifest import Manifest, ManifestReader
 import logging
 import os
 import pkg_resources
 import responses
+import tempfile
+import threading
 import unittest
+import zipfile
 
 
 class TestCompose(unittest.TestCase):
@@ -14,10 +23,14 @@ class TestCompose(unittest.TestCase):
         dirname = pkg_resources.resource_filename(__name__, ".")
         os.environ["COMPOSER_PATH"] = path(dirname)
         os.environ["INTERFACE_PATH"] = path(dirname) / "interfaces"
+        self.cache = path(tempfile.mkdtemp())
+        os.environ["COMPOSER_CACHE"] = self.cache
         path("out").rmtree_p()
 
     def tearDown(self):
         path("out").rmtree_p()
+        self.cache.rmtree_p()
+        del os.environ["COMPOSER_CACHE"]
 
     def test_tester_compose(self):
         composer = juju_compose.Composer()
@@ -63,20 +76,157 @@ class TestCompose(unittest.TestCase):
         self.assertTrue((base / "README.md").exists())
         self.assertEqual("dynamic tactics", (base / "README.md").text())
 
+        # every output file was hashed exactly once
+        self.assertEqual(composer.digests.hashed, len(composer.digests))
+
         sigs = base / ".composer.manifest"
         self.assertTrue(sigs.exists())
-        data = json.load(sigs.open())
-        self.assertEquals(data['signatures']["README.md"], [
-            u'trusty/tester',
+        header = json.loads(sigs.lines()[0])
+        self.assertEquals(header['version'], 4)
+        reader = ManifestReader(sigs)
+        readme = reader.lookup("README.md")
+        self.assertEquals(readme[:3], (
+            'trusty/tester',
             "static",
             u'cfac20374288c097975e9f25a0d7c81783acdbc81'
-            '24302ff4a731a4aea10de99'])
+            '24302ff4a731a4aea10de99'))
+        self.assertEquals(readme.size, (base / "README.md").size)
+        self.assertIsNone(reader.lookup("missing"))
 
-        self.assertEquals(data["signatures"]['metadata.yaml'], [
+        manifest = Manifest.load(sigs)
+        self.assertEquals(manifest['metadata.yaml'][:3], (
             u'trusty/tester',
             "dynamic",
             u'ecb80da834070599ac81190e78448440b442d4eda9'
-            'cea2e4af3a1db58e60e400'])
+            'cea2e4af3a1db58e60e400'))
+
+    def test_validate_uses_stat(self):
+        composer = juju_compose.Composer()
+        composer.log_level = "WARNING"
+        composer.output_dir = "out"
+        composer.series = "trusty"
+        composer.name = "foo"
+        composer.charm = "trusty/b"
+        composer()
+        base = path('out/trusty/foo')
+        manifest = Manifest.load(base / ".composer.manifest")
+
+        # nothing touched, nothing hashed
+        digests = utils.DigestRegistry()
+        self.assertEqual(manifest.delta(base, digests=digests),
+                         (set(), set(), set()))
+        self.assertEqual(digests.hashed, 0)
+
+        # touching a file re-hashes just that file
+        readme = base / "README.md"
+        readme.utime((0, 0))
+        self.assertEqual(manifest.delta(base, digests=digests),
+                         (set(), set(), set()))
+        self.assertEqual(digests.hashed, 1)
+
+        readme.write_text("changed")
+        (base / "a").remove()
+        (base / "extra").write_text("extra")
+        (base / "hooks/relations/mysql/provides.py").write_text("changed")
+        (base / "hooks/relations/mysql/new.py").write_text("new")
+        a, c, d = manifest.delta(base, digests=digests)
+        self.assertEqual(a, set(["extra", "hooks/relations/mysql/new.py"]))
+        self.assertEqual(c, set(["README.md",
+                                 "hooks/relations/mysql/provides.py"]))
+        self.assertEqual(d, set(["a"]))
+
+        # quick mode stops at the first problem
+        a, c, d = manifest.delta(base, quick=True)
+        self.assertEqual(len(a) + len(c) + len(d), 1)
+
+    def test_validate_prunes_ignored(self):
+        composer = juju_compose.Composer()
+        composer.log_level = "WARNING"
+        composer.output_dir = "out"
+        composer.series = "trusty"
+        composer.name = "foo"
+        composer.charm = "trusty/b"
+        composer()
+        base = path('out/trusty/foo')
+        (base / ".git").makedirs_p()
+        (base / ".git" / "HEAD").write_text("ref: refs/heads/master")
+        (base / "hooks" / "cache.pyc").write_text("")
+        self.assertEqual(composer.validate(), (set(), set(), set()))
+
+        (base / "README.md").write_text("changed")
+        composer.quick = True
+        self.assertEqual(composer.validate(),
+                         (set(), set(["README.md"]), set()))
+
+    def test_build_cache(self):
+        def compose():
+            composer = juju_compose.Composer()
+            composer.log_level = "WARNING"
+            composer.output_dir = "out"
+            composer.series = "trusty"
+            composer.name = "foo"
+            composer.charm = "trusty/tester"
+            composer.build_cache = True
+            composer()
+            return composer
+
+        first = compose()
+        self.assertIsNotNone(first.plan)
+        base = path('out/trusty/foo')
+        manifest = Manifest.load(base / ".composer.manifest")
+        path("out").rmtree_p()
+
+        second = compose()
+        # restored from the cache without planning
+        self.assertFalse(hasattr(second, "plan"))
+        self.assertEqual("dynamic tactics", (base / "README.md").text())
+        self.assertTrue((base / "hooks/config-changed").access(os.X_OK))
+        restored = Manifest.load(base / ".composer.manifest")
+        self.assertEqual(
+            dict((k, v.sha256) for k, v in restored.signatures.items()),
+            dict((k, v.sha256) for k, v in manifest.signatures.items()))
+        self.assertEqual(second.validate(), (set(), set(), set()))
+
+        # edits to a restored output don't leak into later restores
+        start = base / "hooks/start"
+        start.write_text("changed")
+        path("out").rmtree_p()
+        compose()
+        self.assertIn("Overridden", start.text())
+
+        # and regenerating over it doesn't write through into the cache
+        compose()
+        start.write_text("changed")
+        self.assertEqual(compose().validate(), (set(), set(), set()))
+
+    def test_cache_server(self):
+        server = CacheServer(("127.0.0.1", 0),
+                             BuildCache(self.cache / "server"))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        def compose():
+            composer = juju_compose.Composer()
+            composer.log_level = "WARNING"
+            composer.output_dir = "out"
+            composer.series = "trusty"
+            composer.name = "foo"
+            composer.charm = "trusty/b"
+            composer.cache_server = server.url
+            composer()
+            return composer
+
+        try:
+            self.assertTrue(hasattr(compose(), "plan"))
+            # a fresh agent gets the output from the server
+            (self.cache / "build").rmtree()
+            path("out").rmtree_p()
+            self.assertFalse(hasattr(compose(), "plan"))
+            self.assertTrue(path("out/trusty/foo/a").exists())
+        finally:
+            server.shutdown()
+            server.server_close()
 
     def test_regenerate_inplace(self):
         # take a generated example where a base layer has changed
@@ -223,6 +373,69 @@ class TestCompose(unittest.TestCase):
         init = hooks / "charmhelpers/__init__.py"
         self.assertTrue(init.exists())
 
+    def _wheel(self, where, name):
+        """Write a pure python wheel installing package name"""
+        files = {
+            "{}/__init__.py".format(name): "VERSION = '1.0'\n",
+            "{}-1.0.dist-info/METADATA".format(name):
+            "Metadata-Version: 2.1\nName: {}\nVersion: 1.0\n".format(name),
+            "{}-1.0.dist-info/WHEEL".format(name):
+            "Wheel-Version: 1.0\nRoot-Is-Purelib: true\n"
+            "Tag: py2.py3-none-any\n",
+        }
+        record = []
+        for name_, data in sorted(files.items()):
+            digest = base64.urlsafe_b64encode(
+                hashlib.sha256(data).digest()).rstrip("=")
+            record.append("{},sha256={},{}".format(name_, digest, len(data)))
+        record_name = "{}-1.0.dist-info/RECORD".format(name)
+        record.append("{},,".format(record_name))
+        files[record_name] = "\n".join(record) + "\n"
+        wheel = where / "{}-1.0-py2.py3-none-any.whl".format(name)
+        with zipfile.ZipFile(wheel, "w") as z:
+            for name_, data in sorted(files.items()):
+                z.writestr(name_, data)
+        return wheel
+
+    def test_pypi_installers_share_directory(self):
+        d = path(tempfile.mkdtemp())
+        self.addCleanup(d.rmtree_p)
+        self.addCleanup(os.environ.__setitem__, "COMPOSER_PATH",
+                        os.environ["COMPOSER_PATH"])
+        os.environ["COMPOSER_PATH"] = d
+        pips = d / "trusty/pips"
+        (pips / "hooks").makedirs_p()
+        for name in ("alpha", "beta"):
+            (pips / "hooks/{}.pypi".format(name)).write_text(
+                self._wheel(d, name) + "\n")
+        top = d / "trusty/piptop"
+        (top / "hooks/alpha").makedirs_p()
+        (top / "composer.yaml").write_text('includes: ["trusty/pips"]\n')
+        (top / "metadata.yaml").write_text("name: piptop\n")
+        (top / "hooks/alpha/extra.py").write_text("EXTRA = True\n")
+
+        composer = juju_compose.Composer()
+        composer.log_level = "WARNING"
+        composer.output_dir = "out"
+        composer.series = "trusty"
+        composer.name = "foo"
+        composer.charm = "trusty/piptop"
+        composer()
+
+        base = path('out/trusty/foo')
+        # the layer file under the installed package survives the install
+        self.assertTrue((base / "hooks/alpha/extra.py").exists())
+        self.assertFalse((base / "hooks/alpha.pypi").exists())
+        self.assertFalse((base / "hooks/beta.pypi").exists())
+        manifest = Manifest.load(base / ".composer.manifest")
+        self.assertEqual(manifest["hooks/alpha/__init__.py"][:2],
+                         ("trusty/pips", "dynamic"))
+        self.assertEqual(manifest["hooks/beta/__init__.py"][:2],
+                         ("trusty/pips", "dynamic"))
+        self.assertEqual(manifest["hooks/alpha/extra.py"][0],
+                         "trusty/piptop")
+        self.assertNotIn("hooks/alpha.pypi", manifest)
+
 
 if __name__ == '__main__':
     logging.basicConfig()
@@ -1,10 +1,25 @@
 import logging
+import os
+import tempfile
 import unittest
 
+from juju_compose import plugins
 from juju_compose.config import ComposerConfig
+from path import path
 
 
 class TestConfig(unittest.TestCase):
+    def setUp(self):
+        # tactics() scans for plugins, keep its cache out of the user's
+        self.d = path(tempfile.mkdtemp())
+        os.environ["COMPOSER_CACHE"] = self.d / "cache"
+        plugins._tactics = None
+
+    def tearDown(self):
+        plugins._tactics = None
+        del os.environ["COMPOSER_CACHE"]
+        self.d.rmtree_p()
+
     def test_rget(self):
         c = ComposerConfig()
         c['a'] = 1
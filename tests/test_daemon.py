@@ -0,0 +1,71 @@
+import os
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+import pkg_resources
+from path import path
+
+from juju_compose import daemon
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        dirname = pkg_resources.resource_filename(__name__, ".")
+        os.environ["COMPOSER_PATH"] = path(dirname)
+        os.environ["INTERFACE_PATH"] = path(dirname) / "interfaces"
+        self.d = path(tempfile.mkdtemp())
+        os.environ["COMPOSER_CACHE"] = self.d / "cache"
+        self.address = self.d / "compose.sock"
+        self.server = daemon.ComposeServer(self.address)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        del os.environ["COMPOSER_CACHE"]
+        self.d.rmtree_p()
+
+    def forward(self, command, *args):
+        out, err = StringIO(), StringIO()
+        code = daemon.forward(command, args, self.address, out, err)
+        return code, out.getvalue(), err.getvalue()
+
+    def test_forward(self):
+        cwd = os.getcwd()
+        out = self.d / "out"
+        args = ("-l", "WARNING", "-o", out, "-n", "foo", "trusty/tester")
+        code, stdout, stderr = self.forward("compose", *args)
+        self.assertEqual(code, 0, stderr)
+        charm = out / "trusty" / "foo"
+        self.assertTrue((charm / ".composer.manifest").exists())
+        self.assertTrue(self.server.resolved)
+        parsed = self.server.documents.parsed
+
+        # the sources are parsed once and the layers resolved once
+        resolved = dict(self.server.resolved)
+        self.assertEqual(self.forward("compose", *args)[0], 0)
+        self.assertEqual(self.server.documents.parsed, parsed)
+        self.assertEqual(self.server.resolved, resolved)
+
+        self.assertEqual(self.forward("validate", *args)[0], 0)
+        code, stdout, stderr = self.forward("inspect", "--format", "json",
+                                            charm)
+        self.assertEqual(code, 0, stderr)
+        self.assertIn('"path": "metadata.yaml"', stdout)
+
+        code, stdout, stderr = self.forward("compose", "--no-such-flag")
+        self.assertEqual(code, 2)
+        self.assertIn("usage:", stderr)
+        self.assertEqual(self.forward("dance")[0], 2)
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_no_server(self):
+        self.assertIsNone(daemon.forward("compose", [], self.d / "missing"))
+
+
+if __name__ == '__main__':
+    unittest.main()
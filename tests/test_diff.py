@@ -0,0 +1,54 @@
+import unittest
+
+from juju_compose import diff
+
+
+def rebuild(diffs):
+    old = "".join(text for op, text in diffs if op != diff.INSERT)
+    new = "".join(text for op, text in diffs if op != diff.DELETE)
+    return old, new
+
+
+class TestDiff(unittest.TestCase):
+    a = "".join("line %d\n" % i for i in range(200))
+    b = (a.replace("line 10\n", "line ten\n")
+         .replace("line 120\n", "")
+         .replace("line 150\n", "line 150\nextra\n")) + "tail"
+
+    def backends(self, timeout=diff.DIFF_TIMEOUT):
+        return [cls(timeout) for cls in diff.BACKENDS.values()
+                if cls.available]
+
+    def test_backends(self):
+        for backend in self.backends():
+            diffs = backend.diff(self.a, self.b)
+            self.assertEqual(rebuild(diffs), (self.a, self.b), backend.name)
+            changed = [(op, text) for op, text in diffs if op != diff.EQUAL]
+            self.assertIn((diff.DELETE, "line 10\n"), changed, backend.name)
+            self.assertIn((diff.INSERT, "line ten\n"), changed, backend.name)
+            self.assertIn((diff.DELETE, "line 120\n"), changed, backend.name)
+            self.assertIn((diff.INSERT, "extra\n"), changed, backend.name)
+
+    def test_repeated_lines(self):
+        # no unique lines, patience falls back to difflib
+        a = "pass\n" * 10 + "x\n" + "pass\n" * 10
+        b = "pass\n" * 10 + "y\n" + "pass\n" * 10
+        for backend in self.backends():
+            diffs = backend.diff(a, b)
+            self.assertEqual(rebuild(diffs), (a, b), backend.name)
+            self.assertEqual(len(diffs), 4, backend.name)
+
+    def test_deadline(self):
+        # an expired deadline still yields a valid, if coarse, diff
+        for backend in self.backends(timeout=1e-9):
+            diffs = backend.diff(self.a, self.b)
+            self.assertEqual(rebuild(diffs), (self.a, self.b), backend.name)
+
+    def test_get_backend(self):
+        self.assertEqual(diff.get_backend().name, "dmp")
+        self.assertEqual(diff.get_backend("difflib", 3).timeout, 3)
+        self.assertRaises(ValueError, diff.get_backend, "meyers")
+
+
+if __name__ == '__main__':
+    unittest.main()
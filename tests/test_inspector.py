@@ -0,0 +1,81 @@
+# coding=utf-8
+import StringIO
+import json
+import tempfile
+import unittest
+
+from juju_compose import inspector
+from juju_compose import utils
+from juju_compose.manifest import Manifest
+from path import path
+
+
+class TestInspector(unittest.TestCase):
+    def setUp(self):
+        self.d = path(tempfile.mkdtemp())
+        for rel in ("README.md", "hooks/install", "hooks/relations/mysql",
+                    "hooks-extra", "metadata.yaml", "build/ignored"):
+            (self.d / rel).dirname().makedirs_p()
+            (self.d / rel).write_text(rel)
+
+    def tearDown(self):
+        self.d.rmtree_p()
+
+    def test_walk_tree(self):
+        ignorer = utils.ignore_matcher(["build/"])
+        walk = [(rel, depth, prefix) for _, rel, depth, prefix, _
+                in inspector.walk_tree(self.d, ignorer)]
+        self.assertEqual(walk, [
+            ("README.md", 0, " ├─── "),
+            ("hooks", 0, " ├─── "),
+            ("hooks/install", 1, " │   ├─── "),
+            ("hooks/relations", 1, " │   └─── "),
+            ("hooks/relations/mysql", 2, " │       └─── "),
+            ("hooks-extra", 0, " ├─── "),
+            ("metadata.yaml", 0, " └─── "),
+        ])
+
+    def test_walk_tree_subtree(self):
+        walk = [(rel, prefix, isdir) for _, rel, _, prefix, isdir
+                in inspector.walk_tree(self.d, start=self.d / "hooks",
+                                       max_depth=1)]
+        self.assertEqual(walk, [
+            ("hooks/install", " ├─── ", False),
+            ("hooks/relations", " └─── ", True),
+        ])
+
+    def test_layer_stats(self):
+        records = [
+            dict(layer="a", kind="static", size=10),
+            dict(layer="b", kind="dynamic", size=20),
+            dict(layer="b", kind="static", size=5),
+            dict(layer=None, kind=None, size=15),
+        ]
+        stats = inspector.layer_stats(records, ["a", "b", "c"])
+        self.assertEqual(list(stats), ["a", "b", "c", None])
+        self.assertEqual(stats["b"], dict(files=2, bytes=25, dynamic=20,
+                                          static=5, share=0.5))
+        self.assertEqual(stats["c"]["files"], 0)
+        self.assertEqual(stats[None]["share"], 0.3)
+
+    def test_dangling_symlink(self):
+        Manifest(["a"]).write(self.d / ".composer.manifest")
+        (self.d / "composer.yaml").write_text("is: a\n")
+        (self.d / "missing").symlink(self.d / "hooks/dangling")
+
+        fp = StringIO.StringIO()
+        inspector.inspect(self.d, format="json", fp=fp)
+        lines = [json.loads(line) for line in fp.getvalue().splitlines()]
+        record = [r for r in lines if r.get("path") == "hooks/dangling"]
+        self.assertEqual(record[0]["size"], None)
+        self.assertEqual(lines[-1]["layers"]["null"]["bytes"],
+                         sum(r["size"] for r in lines[:-1]
+                             if r["size"] is not None))
+
+        fp = StringIO.StringIO()
+        inspector.inspect(self.d, stats=True, fp=fp)
+        self.assertIn("dangling", fp.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
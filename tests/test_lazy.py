@@ -0,0 +1,43 @@
+import json
+import subprocess
+import sys
+import unittest
+
+from juju_compose import lazy
+
+HEAVY = ["requests", "bundletester.fetchers", "ruamel.yaml", "blessings",
+         "pathspec", "juju_compose.diff_match_patch",
+         "juju_compose.fetchers", "numpy"]
+
+PROBE = """
+import json, sys
+import juju_compose, juju_compose.inspector
+before = sorted(sys.modules)
+# first use imports the real module
+juju_compose.inspector.yaml.safe_load
+print json.dumps(dict(before=before, after=sorted(sys.modules)))
+"""
+
+
+class TestLazy(unittest.TestCase):
+    def test_lazy_module(self):
+        mod = lazy.LazyModule("juju_compose.tests_missing_module")
+        self.assertIn("not loaded", repr(mod))
+        self.assertRaises(ImportError, getattr, mod, "anything")
+
+        mod = lazy.LazyModule("colorsys")
+        self.assertEqual(mod.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+        self.assertIs(mod._load(), sys.modules["colorsys"])
+        self.assertTrue(lazy.importable("colorsys"))
+        self.assertFalse(lazy.importable("no_such_module_here"))
+
+    def test_import_is_light(self):
+        output = subprocess.check_output([sys.executable, "-c", PROBE])
+        result = json.loads(output.splitlines()[-1])
+        for name in HEAVY:
+            self.assertNotIn(name, result["before"])
+        self.assertIn("ruamel.yaml", result["after"])
+
+
+if __name__ == '__main__':
+    unittest.main()
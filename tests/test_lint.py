@@ -0,0 +1,125 @@
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from juju_compose import lint
+from juju_compose import utils
+from path import path
+
+
+class TestLint(unittest.TestCase):
+    def setUp(self):
+        self.d = path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        self.d.rmtree_p()
+
+    def pair(self, name, src, target):
+        (self.d / "src").makedirs_p()
+        (self.d / "out").makedirs_p()
+        (self.d / "src" / name).write_text(src)
+        (self.d / "out" / name).write_text(target)
+        return (self.d / "src" / name, self.d / "out" / name,
+                "src/" + name, "out/" + name)
+
+    def test_lint_files(self):
+        handler = "@when('db.ready')\ndef react(db):\n    pass\n"
+        pairs = [
+            self.pair("b.py", handler, handler.replace("db.ready", "db.b")),
+            self.pair("a.py", handler, handler.replace("db.ready", "db.a")),
+            self.pair("same.py", handler, handler),
+            self.pair("plain.py", "x = 1\n", "x = 2\n"),
+        ]
+        result = StringIO()
+        ok = lint.lint_files(pairs + pairs[:1], jobs=2,
+                             term=utils.TermWriter(fp=result))
+        self.assertFalse(ok)
+        output = result.getvalue()
+        # reported once each, in a stable order
+        self.assertEqual(output.count("src/b.py"), 2)
+        self.assertLess(output.index("src/a.py"), output.index("src/b.py"))
+        self.assertNotIn("same.py", output)
+        self.assertNotIn("plain.py", output)
+
+        self.assertTrue(lint.lint_files(pairs[2:], jobs=1,
+                                        term=utils.TermWriter(fp=result)))
+        self.assertTrue(lint.lint_files([]))
+
+    def test_handlers(self):
+        src = (self.d / "mod.py")
+        src.write_text(
+            "from charms.reactive import when, when_not, set_state\n"
+            "class Provides(object):\n"
+            "    @when('{relation_name}.joined',\n"
+            "          'db.ready')\n"
+            "    def joined(self):\n"
+            "        self.set_state('{relation_name}.available')\n"
+            "@when_not('db.ready')\n"
+            "def check():\n"
+            "    pass\n")
+        self.assertEqual(lint.handlers(src), frozenset([
+            ("handler", "Provides.joined", "when",
+             ("{relation_name}.joined", "db.ready")),
+            ("state", "Provides.joined", "set_state",
+             ("{relation_name}.available",)),
+            ("handler", "check", "when_not", ("db.ready",)),
+        ]))
+
+    def test_lint_ast(self):
+        handler = "@when('db.ready')\ndef react(db):\n    pass\n"
+        pairs = [
+            # formatting only
+            self.pair("fmt.py", handler,
+                      "@when(\n    'db.ready'\n)\ndef react(db):\n"
+                      "    return None\n"),
+            self.pair("state.py", handler, handler.replace("ready", "up")),
+        ]
+        result = StringIO()
+        self.assertFalse(lint.lint_files(pairs, jobs=1, mode="ast",
+                                         term=utils.TermWriter(fp=result)))
+        output = result.getvalue()
+        self.assertNotIn("fmt.py", output)
+        self.assertIn("- react: when('db.ready')", output)
+        self.assertIn("+ react: when('db.up')", output)
+        self.assertTrue(lint.lint_files(pairs[:1], jobs=1, mode="ast"))
+
+    def test_lint_cache(self):
+        handler = "@when('db.ready')\ndef react(db):\n    pass\n"
+        pairs = [self.pair("a.py", handler, handler.replace("ready", "up"))]
+        cache = lint.LintCache(self.d / "cache")
+        for mode in lint.MODES:
+            first = StringIO()
+            self.assertFalse(lint.lint_files(
+                pairs, jobs=1, mode=mode, cache=cache,
+                term=utils.TermWriter(fp=first)))
+
+            calls = []
+            delta = lint.delta
+            lint.delta = lambda args: calls.append(args) or delta(args)
+            try:
+                second = StringIO()
+                self.assertFalse(lint.lint_files(
+                    pairs, jobs=1, mode=mode, cache=cache,
+                    term=utils.TermWriter(fp=second)))
+            finally:
+                lint.delta = delta
+            self.assertEqual(calls, [])
+            self.assertEqual(first.getvalue(), second.getvalue())
+
+    def test_lint_cache_expires(self):
+        cache = lint.LintCache(self.d / "cache", max_age=3600)
+        cache.put("aa1", ("diff", []))
+        old = cache._path("aa1")
+        old.utime((0, 0))
+        # pruned at most every PRUNE_INTERVAL seconds
+        cache.put("bb2", ("diff", []))
+        self.assertTrue(old.exists())
+        (self.d / "cache/.pruned").utime((0, 0))
+        cache.put("cc3", ("diff", []))
+        self.assertFalse(old.exists())
+        self.assertIsNone(cache.get("aa1"))
+        self.assertEqual(cache.get("bb2"), ("diff", []))
+
+
+if __name__ == '__main__':
+    unittest.main()
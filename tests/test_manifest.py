@@ -0,0 +1,71 @@
+import json
+import tempfile
+import unittest
+
+from path import path
+from juju_compose.manifest import Entry, Manifest, ManifestReader
+
+
+class TestManifest(unittest.TestCase):
+    def test_streaming(self):
+        d = path(tempfile.mkdtemp())
+        try:
+            layers = ["a", "b", "composer"]
+            sigs = {}
+            for i in range(500):
+                rel = "hooks/{}/f{}".format(i % 7, i)
+                sigs[rel] = Entry(layers[i % 2], "static", str(i), i, i)
+            sigs[".composer.manifest"] = Entry("composer", "dynamic",
+                                               "unchecked", None, None)
+            m = Manifest(layers, sigs)
+            m.write(d / "manifest")
+            self.assertFalse((d / "manifest.tmp").exists())
+
+            reader = ManifestReader(d / "manifest")
+            self.assertEqual(reader.layers, layers)
+            self.assertEqual([rel for rel, _ in reader], sorted(sigs))
+            for rel, e in sigs.items():
+                self.assertEqual(reader.lookup(rel), e)
+            self.assertIsNone(reader.lookup("hooks/0/f"))
+            self.assertIsNone(reader.lookup("zzz"))
+            self.assertIsNone(reader.lookup(""))
+            self.assertEqual([rel for rel, _ in reader.prefixed("hooks/3/")],
+                             sorted(rel for rel in sigs
+                                    if rel.startswith("hooks/3/")))
+            self.assertEqual(list(reader.prefixed("hooks/9/")), [])
+
+            loaded = Manifest.load(d / "manifest")
+            self.assertEqual(loaded.signatures, sigs)
+
+            # version 3 manifests end with a tree of directory digests
+            lines = (d / "manifest").lines()
+            lines[0] = json.dumps(dict(version=3, layers=layers)) + "\n"
+            lines.append(json.dumps(dict(tree={"": ["x", "y"]})) + "\n")
+            (d / "manifest").write_lines(lines, linesep=None)
+            reader = ManifestReader(d / "manifest")
+            self.assertEqual(dict(reader), sigs)
+            self.assertIsNone(reader.lookup("zzz"))
+        finally:
+            d.rmtree_p()
+
+    def test_legacy(self):
+        d = path(tempfile.mkdtemp())
+        try:
+            (d / "manifest").write_text(json.dumps(dict(
+                layers=["a", "composer"],
+                signatures={
+                    "README.md": ["a", "static", "1" * 64],
+                    ".composer.manifest": ["composer", "dynamic",
+                                           "unchecked"]},
+            ), indent=2))
+            m = Manifest.load(d / "manifest")
+            self.assertEqual(m["README.md"],
+                             Entry("a", "static", "1" * 64, None, None))
+            self.assertEqual(
+                ManifestReader(d / "manifest").lookup("README.md").layer, "a")
+        finally:
+            d.rmtree_p()
+
+
+if __name__ == '__main__':
+    unittest.main()
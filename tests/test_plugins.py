@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from juju_compose import plugins
+from juju_compose.tactics import Tactic
+from path import path
+
+
+class TestPlugins(unittest.TestCase):
+    def setUp(self):
+        self.d = path(tempfile.mkdtemp())
+        os.environ["COMPOSER_CACHE"] = self.d / "cache"
+        site = self.d / "site"
+        (site / "rsttactics").makedirs_p()
+        (site / "rsttactics" / "__init__.py").write_text(
+            "from juju_compose.tactics import Tactic\n"
+            "class RSTTactic(Tactic):\n"
+            "    @classmethod\n"
+            "    def trigger(cls, relpath):\n"
+            "        return not relpath.startswith('skip')\n")
+        info = site / "rsttactics-1.0.egg-info"
+        info.makedirs_p()
+        info.joinpath("PKG-INFO").write_text(
+            "Metadata-Version: 1.0\nName: rsttactics\nVersion: 1.0\n")
+        info.joinpath("entry_points.txt").write_text(
+            "[juju_compose.tactics]\n*.rst = rsttactics:RSTTactic\n")
+        sys.path.append(site)
+        plugins._tactics = None
+
+    def tearDown(self):
+        plugins._tactics = None
+        sys.path.remove(self.d / "site")
+        sys.modules.pop("rsttactics", None)
+        del os.environ["COMPOSER_CACHE"]
+        self.d.rmtree_p()
+
+    def test_entry_points(self):
+        expected = [["*.rst", "rsttactics", "RSTTactic"]]
+        self.assertEqual(plugins.entry_points(), expected)
+        # served from the cache while sys.path is unchanged
+        scan = plugins._scan
+        plugins._scan = None
+        try:
+            self.assertEqual(plugins.entry_points(), expected)
+        finally:
+            plugins._scan = scan
+
+    def test_lazy_tactic(self):
+        tactic = plugins.LazyTactic("*.rst", "rsttactics", "RSTTactic")
+        self.assertFalse(tactic.trigger("README.md"))
+        self.assertNotIn("rsttactics", sys.modules)
+        self.assertFalse(tactic.trigger("skip.rst"))
+        self.assertTrue(tactic.trigger("docs/index.rst"))
+        self.assertTrue(issubclass(tactic.tactic, Tactic))
+        instance = tactic(entity=None, current=None, target=None,
+                          config=None)
+        self.assertIsInstance(instance, tactic.tactic)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,14 @@
+import gc
+import os
+import subprocess
+import tempfile
+import time
+import warnings
 from unittest import TestCase
+
 from juju_compose import utils
+from ruamel import yaml
+from path import path
 from StringIO import StringIO
 
 
@@ -41,3 +50,303 @@ class TestUtils(TestCase):
         self.assertIn("Beta", output)
         self.assertIn("@when('db.ready'", output)
         self.assertIn("bar", output)
+
+    def test_delta_python_hunks(self):
+        a = "@when('db.ready')\ndef react(db):\n    return 1\n\n\nx = 1\n"
+        b = ("@when('db.ready', 'bar')\n"
+             "def react(db):\n    return 1\n\n\nx = 2\n")
+        # identical sources are skipped without diffing
+        self.assertEqual(list(utils.delta_python(StringIO(a),
+                                                 StringIO(a))), [])
+        # the change at the top of the file has no preceding context, the
+        # change to x is too far from a handler to be reported
+        hunks = list(utils.delta_python(StringIO(a), StringIO(b)))
+        self.assertEqual([(lineno, last, current[1])
+                          for lineno, last, current in hunks], [
+            (1, None, "@when('db.ready')\n"),
+            (1, None, "@when('db.ready', 'bar')\n"),
+        ])
+        result = StringIO()
+        self.assertFalse(utils.delta_python_dump(
+            StringIO(a), StringIO(b), term=utils.TermWriter(fp=result)))
+        self.assertIn("'bar'", result.getvalue())
+
+    def test_process(self):
+        lines = []
+
+        class Log(object):
+            def debug(self, msg, *args):
+                lines.append(msg % args)
+
+        result = utils.Process(("sh", "-c"), log=Log())(
+            "echo one; echo two >&2; exit 3")
+        self.assertEqual(result.exit_code, 3)
+        self.assertEqual(result.output, "one\ntwo")
+        self.assertIn("one", lines)
+        self.assertIn("two", lines)
+
+        result = utils.Process(("sh", "-c"), max_output=2)(
+            "for i in 1 2 3 4; do echo $i; done")
+        self.assertEqual(result.stdout, "3\n4")
+
+        result = utils.Process(("sleep", "10"), timeout=0.2)()
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result)
+
+        # killed when ignoring the terminate, the killer is cancelled once
+        # the process is gone
+        running = utils.Process(("sh", "-c"), timeout=0.1).start(
+            "trap '' TERM; exec sleep 10")
+        running.KILL_AFTER = 0.1
+        result = running.wait()
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.exit_code, -9)
+        running._killer.join(1)
+        self.assertFalse(running._killer.is_alive())
+
+    def test_process_pool(self):
+        d = path(tempfile.mkdtemp())
+        self.addCleanup(d.rmtree_p)
+
+        def appears(*names):
+            utils.wait_for(30, 0.05, *[(d / n).exists for n in names])
+
+        # each job marks itself running until its release file shows up
+        script = ('touch {0}/run.$0; '
+                  'while [ ! -e {0}/release.$0 ]; do sleep 0.01; done; '
+                  'rm {0}/run.$0; echo $0'.format(d))
+        marker = utils.Process(("sh", "-c", script))
+        with utils.ProcessPool(2) as pool:
+            jobs = [pool.submit(marker, str(i)) for i in range(4)]
+            # two run at once, the others wait for a free worker
+            appears("run.0", "run.1")
+            self.assertFalse((d / "run.2").exists())
+            self.assertFalse((d / "run.3").exists())
+            (d / "release.0").touch()
+            appears("run.2")
+            self.assertFalse((d / "run.3").exists())
+            for i in range(1, 4):
+                (d / "release.{}".format(i)).touch()
+            self.assertEqual([j.result(30).stdout for j in jobs],
+                             ["0", "1", "2", "3"])
+            results = pool.map(utils.Process(("echo",)),
+                               [(str(i),) for i in range(4)])
+            self.assertEqual([r.stdout for r in results],
+                             ["0", "1", "2", "3"])
+
+            running = pool.submit(marker, "4")
+            queued = [pool.submit(utils.Process(("sleep", "10")))
+                      for i in range(2)]
+            appears("run.4")
+            for job in [running] + queued:
+                job.cancel()
+            for job in [running] + queued:
+                self.assertRaises(utils.ProcessCancelled, job.result, 5)
+
+            failing = pool.submit(utils.Process(("false",)).throw_on_error())
+            self.assertRaises(subprocess.CalledProcessError,
+                              failing.result, 5)
+
+    def test_wait_for(self):
+        ready = [time.time() + 0.3]
+        start = time.time()
+        # checked straight away and backing off rather than every interval
+        self.assertTrue(utils.wait_for(5, 20, lambda: True))
+        self.assertTrue(utils.wait_for(5, 20,
+                                       lambda: time.time() > ready[0]))
+        self.assertLess(time.time() - start, 2)
+
+        start = time.time()
+        self.assertRaises(OSError, utils.wait_for, 0.3, 0.1, lambda: False)
+        self.assertLess(time.time() - start, 1)
+        self.assertLessEqual(utils.monotonic(), utils.monotonic())
+        platform = utils.sys.platform
+        try:
+            utils.sys.platform = "darwin"
+            self.assertIsNone(utils._clock_gettime())
+        finally:
+            utils.sys.platform = platform
+
+        calls = []
+        self.assertTrue(utils.retry(3, lambda: calls.append(1) or
+                                    len(calls) == 3, delay=0.01))
+        calls = []
+        self.assertRaises(OSError, utils.retry, 2,
+                          lambda: calls.append(1) or False)
+        self.assertEqual(len(calls), 2)
+
+    def test_watcher(self):
+        checked = {"fast": 0, "slow": 0}
+        ready = time.time() + 0.3
+
+        def condition(name):
+            def check():
+                checked[name] += 1
+                return name == "fast" or time.time() > ready
+            return check
+
+        watcher = utils.Watcher()
+        watcher.add(condition("fast"))
+        watcher.add(condition("slow"), utils.Backoff(0.05, 0.1))
+        self.assertTrue(watcher.wait(5))
+        # each on its own schedule, the first stopping once it passed
+        self.assertEqual(checked["fast"], 1)
+        self.assertGreater(checked["slow"], 1)
+        self.assertRaises(OSError, utils.Watcher().add(lambda: False).wait,
+                          0.2)
+
+    def test_digest_registry(self):
+        d = path(tempfile.mkdtemp())
+        try:
+            f = d / "a"
+            f.write_text("alpha")
+            digests = utils.DigestRegistry()
+            self.assertEqual(digests(f), utils.sign(f))
+            self.assertEqual(digests(d / "." / "a"), utils.sign(f))
+            self.assertEqual(digests.hashed, 1)
+            self.assertIsNone(digests(d))
+            self.assertIsNone(digests(d / "missing"))
+
+            # rewriting the file changes its fingerprint
+            f.write_text("alpha and omega")
+            self.assertEqual(digests(f), utils.sign(f))
+            self.assertEqual(digests.hashed, 2)
+        finally:
+            d.rmtree_p()
+
+    def test_nested_dict(self):
+        d = utils.NestedDict({"a": {"b": 1}})
+        d["x.y.z"] = 2
+        self.assertEqual(d["x.y.z"], 2)
+        self.assertEqual(d.x.y.z, 2)
+        self.assertEqual(d.get("a.b"), 1)
+        self.assertIsNone(d.get("a.b.c"))
+        self.assertRaises(KeyError, lambda: d["x.q"])
+        self.assertRaises(AttributeError, getattr, d, "q")
+
+        # changes through any NestedDict of the tree invalidate lookups
+        d["x"]["y"]["z"] = 3
+        self.assertEqual(d["x.y.z"], 3)
+        del d["x"]["y"]
+        self.assertIsNone(d.get("x.y.z"))
+        d.update({"x": {"y": {"z": 4}}})
+        self.assertEqual(d["x.y.z"], 4)
+        d["x.y"].clear()
+        self.assertIsNone(d.get("x.y.z"))
+
+        # misses are indexed too
+        self.assertIsNone(d.get("x.y.w"))
+        d["x.y.w"] = 6
+        self.assertEqual(d.get("x.y.w"), 6)
+
+        # plain dicts aren't indexed so direct changes are still seen
+        self.assertEqual(d["a.b"], 1)
+        d["a"]["b"] = 5
+        self.assertEqual(d["a.b"], 5)
+        self.assertIsNone(d.get("a.c"))
+        d["a"]["c"] = 7
+        self.assertEqual(d.a["c"], 7)
+        self.assertEqual(d.get("a.c"), 7)
+
+    def test_merge(self):
+        base = yaml.load("options:\n"
+                         "  a:\n"
+                         "    default: 1  # keep me\n"
+                         "  b:\n"
+                         "    default: 2\n"
+                         "name: base\n", Loader=yaml.RoundTripLoader)
+        overlay = yaml.load("options:\n"
+                            "  b:\n"
+                            "    default: 3  # from the overlay\n"
+                            "  c:\n"
+                            "    default: 4\n", Loader=yaml.RoundTripLoader)
+        merged = utils.merge(base, overlay)
+        # inputs are untouched and unchanged subtrees shared
+        self.assertEqual(base["options"]["b"]["default"], 2)
+        self.assertNotIn("c", base["options"])
+        self.assertIs(merged["options"]["a"], base["options"]["a"])
+        self.assertIs(merged["options"]["c"], overlay["options"]["c"])
+        self.assertIs(merged["name"], base["name"])
+        self.assertEqual(merged["options"]["b"]["default"], 3)
+        self.assertIs(utils.merge(base, {"name": "base"}), base)
+
+        removed = utils.without_path("options.b", merged)
+        self.assertIn("b", merged["options"])
+        self.assertEqual(list(removed["options"]), ["a", "c"])
+        self.assertIs(removed["options"]["a"], base["options"]["a"])
+        self.assertRaises(KeyError, utils.without_path, "options.z", merged)
+
+        dumped = yaml.dump(merged, Dumper=yaml.RoundTripDumper,
+                           default_flow_style=False)
+        self.assertIn("# keep me", dumped)
+        self.assertIn("# from the overlay", dumped)
+
+    def test_load_class(self):
+        d = path(tempfile.mkdtemp())
+        os.environ["COMPOSER_CACHE"] = d / "cache"
+        try:
+            mod = d / "generate" / "custom.py"
+            mod.dirname().makedirs_p()
+            mod.write_text("class Tactic(object):\n    version = 1\n")
+            cwd = os.getcwd()
+            klass = utils.load_class("generate.custom.Tactic", d)
+            self.assertEqual(os.getcwd(), cwd)
+            self.assertEqual(klass.version, 1)
+            self.assertEqual(klass.__module__, "generate.custom")
+            self.assertIs(utils.load_class("generate.custom.Tactic", d),
+                          klass)
+            self.assertTrue((d / "cache" / "bytecode").exists())
+
+            # stale bytecode is dropped as new modules are compiled
+            stale = d / "cache" / "bytecode" / "00" / "stale"
+            stale.dirname().makedirs_p()
+            stale.write_bytes("")
+            stale.utime((0, 0))
+            (d / "cache" / "bytecode" / ".pruned").utime((0, 0))
+            other = d / "generate" / "other.py"
+            other.write_text("class Tactic(object):\n    pass\n")
+            utils.load_class("generate.other.Tactic", d)
+            self.assertFalse(stale.exists())
+
+            mod.write_text("import json\n"
+                           "class Tactic(object):\n    version = 22\n"
+                           "    def dump(self):\n"
+                           "        return json.dumps(self.version)\n")
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                klass = utils.load_class("generate.custom.Tactic", d)
+                self.assertEqual(klass.version, 22)
+            # no "Parent module 'generate' not found" for the import
+            self.assertEqual(caught, [])
+            # the module's globals outlive the load
+            gc.collect()
+            self.assertEqual(klass().dump(), "22")
+            self.assertRaises(ImportError, utils.load_class,
+                              "generate.custom.Missing", d)
+            self.assertRaises(OSError, utils.load_class,
+                              "generate.missing.Tactic", d)
+        finally:
+            del os.environ["COMPOSER_CACHE"]
+            d.rmtree_p()
+
+    def test_persistent_digest_registry(self):
+        d = path(tempfile.mkdtemp())
+        try:
+            f = d / "a"
+            f.write_text("alpha")
+            old = time.time() - 60
+            os.utime(f, (old, old))
+            g = d / "b"
+            g.write_text("beta")
+            digests = utils.PersistentDigestRegistry(d / "cache.json")
+            digests(f)
+            digests(g)
+            digests.save()
+
+            # only the entry that can't be racily clean was saved
+            digests = utils.PersistentDigestRegistry(d / "cache.json")
+            self.assertEqual(digests(f), utils.sign(f))
+            self.assertEqual(digests(g), utils.sign(g))
+            self.assertEqual(digests.hashed, 1)
+        finally:
+            d.rmtree_p()
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import pkg_resources
+from path import path
+from ruamel import yaml
+
+import juju_compose
+from juju_compose import watch
+from juju_compose.manifest import Manifest
+
+
+class TestWatchers(unittest.TestCase):
+    def setUp(self):
+        self.d = path(tempfile.mkdtemp())
+        (self.d / "a").write_text("a")
+
+    def tearDown(self):
+        self.d.rmtree_p()
+
+    def check(self, watcher):
+        try:
+            self.assertEqual(watcher.changes(0.1), set())
+            (self.d / "a").write_text("changed")
+            (self.d / "sub").mkdir()
+            (self.d / "sub" / "b").write_text("b")
+            changed = set()
+            for batch in watch.batches(watcher, quiet=0.3, timeout=2):
+                changed |= batch
+                break
+            self.assertIn(self.d / "a", changed)
+            self.assertIn(self.d / "sub" / "b", changed)
+
+            (self.d / "sub" / "b").remove()
+            self.assertIn(self.d / "sub" / "b",
+                          next(watch.batches(watcher, timeout=2)))
+        finally:
+            watcher.close()
+
+    def test_inotify(self):
+        self.check(watch.InotifyWatcher([self.d]))
+
+    def test_polling(self):
+        self.check(watch.PollingWatcher([self.d], interval=0.05))
+
+
+class TestWatchCompose(unittest.TestCase):
+    def setUp(self):
+        dirname = path(pkg_resources.resource_filename(__name__, "."))
+        self.d = path(tempfile.mkdtemp())
+        # layers we can change
+        dirname.joinpath("trusty").copytree(self.d / "trusty")
+        dirname.joinpath("interfaces").copytree(self.d / "interfaces")
+        os.environ["COMPOSER_PATH"] = self.d
+        os.environ["INTERFACE_PATH"] = self.d / "interfaces"
+        os.environ["COMPOSER_CACHE"] = self.d / "cache"
+        self.composer = juju_compose.Composer()
+        self.composer.log_level = "WARNING"
+        self.composer.output_dir = self.d / "out"
+        self.composer.series = "trusty"
+        self.composer.name = "foo"
+        self.composer.charm = "trusty/tester"
+        self.base = self.d / "out" / "trusty" / "foo"
+
+    def tearDown(self):
+        del os.environ["COMPOSER_CACHE"]
+        self.d.rmtree_p()
+
+    def manifest(self):
+        return Manifest.load(self.base / ".composer.manifest")
+
+    def test_update(self):
+        composer = self.composer
+        composer()
+        before = self.manifest()
+        tester = self.d / "trusty" / "tester"
+        mysql = self.d / "trusty" / "mysql"
+
+        (tester / "hooks" / "start").write_text("#!/bin/sh\necho again\n")
+        (tester / "hooks" / "extra").write_text("extra")
+        (mysql / "config.yaml").write_text(
+            (mysql / "config.yaml").text().replace(
+                "bind-address:", "bind-addr:"))
+        self.assertTrue(composer.update(
+            set(["hooks/start", "hooks/extra", "config.yaml"])))
+        after = self.manifest()
+        self.assertEqual((self.base / "hooks" / "start").text(),
+                         "#!/bin/sh\necho again\n")
+        self.assertEqual(after["hooks/extra"].layer, "trusty/tester")
+        self.assertNotEqual(after["hooks/start"].sha256,
+                            before["hooks/start"].sha256)
+        # re-merged through the layers, applying the tester's deletes
+        options = yaml.load((self.base / "config.yaml").open())["options"]
+        self.assertIn("bind-addr", options)
+        self.assertNotIn("vip", options)
+        # untouched entries are kept as they were
+        self.assertEqual(after["README.md"], before["README.md"])
+        self.assertEqual(after.layers, before.layers)
+
+        (tester / "hooks" / "extra").remove()
+        self.assertTrue(composer.update(set(["hooks"])))
+        self.assertFalse((self.base / "hooks" / "extra").exists())
+        self.assertNotIn("hooks/extra", self.manifest())
+        self.assertIn("hooks/start", self.manifest())
+
+        self.assertFalse(composer.update(set(["composer.yaml"])))
+
+    def test_watch_layers(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=self.composer.watch_layers,
+                                  args=(stop, 0.1))
+        thread.start()
+        try:
+            start = self.base / "hooks" / "start"
+            deadline = time.time() + 30
+            while not start.exists() and time.time() < deadline:
+                time.sleep(0.1)
+            time.sleep(0.5)
+            (self.d / "trusty" / "tester" / "hooks" / "start").write_text(
+                "watched")
+            while start.text() != "watched" and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(start.text(), "watched")
+        finally:
+            stop.set()
+            thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,3 +15,7 @@ class READMETactic(Tactic):
         rel = self.entity.relpath(self.current.directory)
         target = self.target.directory / rel
         target.write_text("dynamic tactics")
+
+    def sign(self):
+        # written before sign() took the build's digests
+        return super(READMETactic, self).sign()